@@ -0,0 +1,445 @@
+import asyncio
+from collections import deque
+import itertools
+import json
+import queue
+import random
+import re
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import aiohttp
+
+from chunk_codecs import gzip_compressobj, gzip_member
+from trace_cache import TraceCache
+
+# fetch mode -> the (tracer, tracerConfig) calls made per block, in the order their results are returned
+TRACER_CONFIGS: Dict[str, List[Tuple[str, dict]]] = {
+    "prestate": [("prestateTracer", {"diffMode": False}), ("prestateTracer", {"diffMode": True})],
+    "call": [("callTracer", {})],
+}
+
+# streamed responses are read in pieces of STREAM_READ_SIZE bytes, and the last STREAM_TAIL_SIZE bytes
+# are held back until the end, so the members following "result" can be cut off
+STREAM_READ_SIZE = 1 << 16
+STREAM_TAIL_SIZE = 256
+STREAM_HEAD_LIMIT = 1 << 16
+RESULT_KEY = re.compile(rb'"result"\s*:\s*')
+RESPONSE_TRAILER = re.compile(rb'(\s*,\s*"(?:jsonrpc|id)"\s*:\s*(?:"[^"]*"|-?\d+|null))*\s*\}\s*$')
+
+
+class RpcError(Exception):
+    pass
+
+
+class Endpoint:
+    """One RPC url, with its own concurrency limit and health state."""
+
+    def __init__(self, url: str, concurrency: int):
+        self.url = url
+        self.concurrency = concurrency
+        self.in_flight = 0
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self.successes = 0
+        self.failures = 0
+
+    def is_available(self, now: float) -> bool:
+        return self.cooldown_until <= now and self.in_flight < self.concurrency
+
+    def record_success(self) -> None:
+        self.successes += 1
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+
+    def record_failure(self, cooldown: float) -> None:
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.cooldown_until = time.monotonic() + cooldown
+
+
+class AsyncTraceFetcher:
+    """
+    Fetches debug_traceBlockByNumber results over pooled keep-alive connections, rotating across urls.
+    A failed call is retried with exponential backoff and full jitter on the next available endpoint,
+    and puts its endpoint in a cooldown that grows with its consecutive failures.
+    With a cache, traces found in it are not requested, and fetched traces are added to it.
+    """
+
+    def __init__(self, urls: List[str], concurrency_per_endpoint: int = 4, max_retries: int = 5,
+                 base_delay: float = 1.0, max_delay: float = 60.0, timeout: float = 600.0, cache: Optional[TraceCache] = None):
+        self.endpoints = [Endpoint(url, concurrency_per_endpoint) for url in urls]
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.cache = cache
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.endpoint_released: Optional[asyncio.Condition] = None
+        self.request_ids = itertools.count(1)
+        self.rotation = itertools.count()
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=sum(endpoint.concurrency for endpoint in self.endpoints))
+        self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+        self.endpoint_released = asyncio.Condition()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def acquire_endpoint(self) -> Endpoint:
+        # round robin over the endpoints that are out of cooldown and under their concurrency limit
+        async with self.endpoint_released:
+            while True:
+                now = time.monotonic()
+                start = next(self.rotation)
+                for i in range(len(self.endpoints)):
+                    endpoint = self.endpoints[(start + i) % len(self.endpoints)]
+                    if endpoint.is_available(now):
+                        endpoint.in_flight += 1
+                        return endpoint
+                cooldowns = [endpoint.cooldown_until - now for endpoint in self.endpoints if endpoint.cooldown_until > now]
+                try:
+                    await asyncio.wait_for(self.endpoint_released.wait(), min(cooldowns, default=None))
+                except asyncio.TimeoutError:
+                    pass
+
+    async def release_endpoint(self, endpoint: Endpoint) -> None:
+        async with self.endpoint_released:
+            endpoint.in_flight -= 1
+            self.endpoint_released.notify_all()
+
+    async def post(self, endpoint: Endpoint, payload):
+        async with self.session.post(endpoint.url, json=payload) as response:
+            if response.status != 200:
+                raise RpcError(f"HTTP {response.status}: {await response.text()}")
+            return await response.json(content_type=None)
+
+    async def post_compressed(self, endpoint: Endpoint, payload, level: int) -> Optional[bytes]:
+        """
+        Streams the response into a gzip member of the raw json text of its "result", never decoding it,
+        so memory is bounded by the compressed result instead of several copies of the parsed trace.
+        Relies on the node writing "result" as a top-level member, after "jsonrpc" and "id" or before them.
+        Returns None for a null result.
+        """
+        async with self.session.post(endpoint.url, json=payload) as response:
+            if response.status != 200:
+                raise RpcError(f"HTTP {response.status}: {await response.text()}")
+            compressor = gzip_compressobj(level)
+            compressed = []
+            result_size = 0
+            head = b""
+            tail = b""
+            async for data in response.content.iter_chunked(STREAM_READ_SIZE):
+                if head is not None:
+                    head += data
+                    match = RESULT_KEY.search(head)
+                    if match is None:
+                        if len(head) > STREAM_HEAD_LIMIT:
+                            raise ValueError(f"no result in the first {len(head)} bytes of the response")
+                        continue
+                    data = head[match.end():]
+                    head = None
+                data = tail + data
+                tail = data[-STREAM_TAIL_SIZE:]
+                compressed.append(compressor.compress(data[:-STREAM_TAIL_SIZE]))
+                result_size += max(0, len(data) - STREAM_TAIL_SIZE)
+        if head is not None:
+            # no result, most likely an error response, which is small enough to decode
+            response = json.loads(head)
+            raise RpcError(response.get("error", response) if isinstance(response, dict) else response)
+        trailer = RESPONSE_TRAILER.search(tail)
+        if trailer is None:
+            raise ValueError(f"unexpected end of response {tail[-64:]!r}")
+        if result_size == 0 and tail[:trailer.start()].strip() == b"null":
+            return None
+        compressed.append(compressor.compress(tail[:trailer.start()]))
+        compressed.append(compressor.flush())
+        return b"".join(compressed)
+
+    async def call(self, method: str, params: list):
+        payload = {"jsonrpc": "2.0", "method": method, "params": params, "id": next(self.request_ids)}
+        for attempt in range(self.max_retries + 1):
+            endpoint = await self.acquire_endpoint()
+            try:
+                response = await self.post(endpoint, payload)
+                if "error" in response:
+                    raise RpcError(response["error"])
+                endpoint.record_success()
+                return response["result"]
+            except (aiohttp.ClientError, asyncio.TimeoutError, RpcError, ValueError) as e:
+                endpoint.record_failure(self.backoff(endpoint.consecutive_failures))
+                print(f"Error calling {method} on {endpoint.url} (attempt {attempt + 1}): {e}")
+                if attempt == self.max_retries:
+                    raise
+            finally:
+                await self.release_endpoint(endpoint)
+            # after releasing, so a failed call doesn't hold one of the endpoint's slots while backing off
+            await asyncio.sleep(self.backoff(attempt))
+
+    async def call_compressed(self, method: str, params: list, level: int) -> Optional[bytes]:
+        # same as call, with the result returned as a gzip member of its json text (see post_compressed)
+        payload = {"jsonrpc": "2.0", "method": method, "params": params, "id": next(self.request_ids)}
+        for attempt in range(self.max_retries + 1):
+            endpoint = await self.acquire_endpoint()
+            try:
+                result = await self.post_compressed(endpoint, payload, level)
+                endpoint.record_success()
+                return result
+            except (aiohttp.ClientError, asyncio.TimeoutError, RpcError, ValueError) as e:
+                endpoint.record_failure(self.backoff(endpoint.consecutive_failures))
+                print(f"Error calling {method} on {endpoint.url} (attempt {attempt + 1}): {e}")
+                if attempt == self.max_retries:
+                    raise
+            finally:
+                await self.release_endpoint(endpoint)
+            await asyncio.sleep(self.backoff(attempt))
+
+    async def call_batch(self, calls: List[Tuple[str, list]]) -> list:
+        """
+        Sends calls as one JSON-RPC batch request, retrying the request as a whole on transport errors.
+        Returns one result per call, or the RpcError of a call the endpoint answered with an error.
+        """
+        payload = [
+            {"jsonrpc": "2.0", "method": method, "params": params, "id": next(self.request_ids)}
+            for method, params in calls
+        ]
+        for attempt in range(self.max_retries + 1):
+            endpoint = await self.acquire_endpoint()
+            try:
+                responses = await self.post(endpoint, payload)
+                if not isinstance(responses, list):
+                    raise RpcError(responses.get("error", responses) if isinstance(responses, dict) else responses)
+                endpoint.record_success()
+                responses = {response.get("id"): response for response in responses}
+                results = []
+                for request in payload:
+                    response = responses.get(request["id"])
+                    if response is None:
+                        results.append(RpcError(f"no response to {request['method']}"))
+                    elif "error" in response:
+                        results.append(RpcError(response["error"]))
+                    else:
+                        results.append(response["result"])
+                return results
+            except (aiohttp.ClientError, asyncio.TimeoutError, RpcError, ValueError) as e:
+                endpoint.record_failure(self.backoff(endpoint.consecutive_failures))
+                print(f"Error sending a batch of {len(calls)} calls to {endpoint.url} (attempt {attempt + 1}): {e}")
+                if attempt == self.max_retries:
+                    return [e] * len(calls)
+            finally:
+                await self.release_endpoint(endpoint)
+            await asyncio.sleep(self.backoff(attempt))
+
+    async def cached(self, function, *args):
+        # cache file reads, writes and json decoding run off the event loop;
+        # a failing cache (full disk, permissions, corrupt file) only costs the lookup, never a fetched trace
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+        except Exception as e:
+            print(f"Error using the trace cache in {function.__name__}{args[:3]}: {e}")
+            return None
+
+    async def fetch_blocks_batched(self, block_numbers: List[int], mode: str):
+        # every uncached tracer config of every block in one batch request, failed calls retried one by one
+        calls = [
+            (block_number, tracer_name, tracer_config)
+            for block_number in block_numbers
+            for tracer_name, tracer_config in TRACER_CONFIGS[mode]
+        ]
+        results = [None] * len(calls)
+        if self.cache is not None:
+            results = await asyncio.gather(*(self.cached(self.cache.get, *call) for call in calls))
+        uncached = [i for i, result in enumerate(results) if result is None]
+        if len(uncached) > 0:
+            batch_results = await self.call_batch([
+                ("debug_traceBlockByNumber", [hex(calls[i][0]), {"tracer": calls[i][1], "tracerConfig": calls[i][2]}])
+                for i in uncached
+            ])
+            for i, result in zip(uncached, batch_results):
+                results[i] = result
+                if self.cache is not None and not isinstance(result, Exception):
+                    await self.cached(self.cache.put, *calls[i], result)
+        traces = await asyncio.gather(*(
+            self.fetch_block_trace(*call) if isinstance(result, Exception) else asyncio.sleep(0, result)
+            for call, result in zip(calls, results)
+        ))
+        print(f"fetched block traces {block_numbers[0]}..{block_numbers[-1]} with {mode} in one batch")
+        configs_count = len(TRACER_CONFIGS[mode])
+        return [
+            (block_number, *traces[i * configs_count:(i + 1) * configs_count])
+            for i, block_number in enumerate(block_numbers)
+        ]
+
+    async def fetch_block_trace(self, block_number: int, tracer_name: str, tracer_config: dict = {}):
+        if self.cache is not None:
+            result = await self.cached(self.cache.get, block_number, tracer_name, tracer_config)
+            if result is not None:
+                return result
+        try:
+            result = await self.call("debug_traceBlockByNumber", [hex(block_number), {"tracer": tracer_name, "tracerConfig": tracer_config}])
+            print(f"fetched block trace {block_number} with {tracer_name}, {tracer_config}")
+            if self.cache is not None:
+                await self.cached(self.cache.put, block_number, tracer_name, tracer_config, result)
+            return result
+        except Exception as e:
+            print(f"Error tracing block {block_number}: {e}")
+            return None
+
+    async def fetch_block(self, block_number: int, mode: str):
+        traces = await asyncio.gather(*(
+            self.fetch_block_trace(block_number, tracer_name, tracer_config)
+            for tracer_name, tracer_config in TRACER_CONFIGS[mode]
+        ))
+        return (block_number, *traces)
+
+    async def fetch_block_trace_compressed(self, block_number: int, tracer_name: str, tracer_config: dict, level: int) -> Optional[bytes]:
+        if self.cache is not None:
+            result = await self.cached(self.cache.get_compressed, block_number, tracer_name, tracer_config)
+            if result is not None:
+                return result
+        try:
+            result = await self.call_compressed("debug_traceBlockByNumber", [hex(block_number), {"tracer": tracer_name, "tracerConfig": tracer_config}], level)
+            print(f"fetched block trace {block_number} with {tracer_name}, {tracer_config}")
+            if self.cache is not None and result is not None:
+                await self.cached(self.cache.put_compressed, block_number, tracer_name, tracer_config, result)
+            return result
+        except Exception as e:
+            print(f"Error tracing block {block_number}: {e}")
+            return None
+
+    async def fetch_block_compressed(self, block_number: int, mode: str, level: int):
+        # (block_number, gzip member of the json entry [block_number, *traces], whether no trace is None),
+        # see chunk_codecs.join_gzip_members
+        traces = await asyncio.gather(*(
+            self.fetch_block_trace_compressed(block_number, tracer_name, tracer_config, level)
+            for tracer_name, tracer_config in TRACER_CONFIGS[mode]
+        ))
+        complete = all(trace is not None for trace in traces)
+        traces = [trace if trace is not None else gzip_member(b"null", level) for trace in traces]
+        entry = gzip_member(b"[%d," % block_number, level) + gzip_member(b",", level).join(traces) + gzip_member(b"]", level)
+        return block_number, entry, complete
+
+    async def fetch_blocks(self, block_numbers: Iterable[int], mode: str, window: int, batch_size: Optional[int] = None,
+                           compression_level: Optional[int] = None):
+        """
+        Yields (block_number, *traces) in block order, with at most window blocks in flight.
+        With batch_size, each request is a JSON-RPC batch of all tracer configs of batch_size blocks.
+        With compression_level, yields (block_number, compressed entry, complete) from fetch_block_compressed instead.
+        """
+        block_numbers = iter(block_numbers)
+        if compression_level is not None:
+            if batch_size is not None:
+                raise Exception("compressed fetching streams each trace, it can't be batched")
+            groups = ([block_number] for block_number in block_numbers)
+            fetch_group = lambda group: self.fetch_block_compressed(group[0], mode, compression_level)
+        elif batch_size is None:
+            groups = ([block_number] for block_number in block_numbers)
+            fetch_group = lambda group: self.fetch_block(group[0], mode)
+        else:
+            groups = iter(lambda: list(itertools.islice(block_numbers, batch_size)), [])
+            fetch_group = lambda group: self.fetch_blocks_batched(group, mode)
+        groups_window = max(1, window // (batch_size or 1))
+        in_flight = deque(asyncio.ensure_future(fetch_group(group)) for group in itertools.islice(groups, groups_window))
+        try:
+            while len(in_flight) > 0:
+                results = await in_flight.popleft()
+                next_group = next(groups, None)
+                if next_group is not None:
+                    in_flight.append(asyncio.ensure_future(fetch_group(next_group)))
+                if batch_size is None:
+                    yield results
+                else:
+                    for result in results:
+                        yield result
+        finally:
+            # stopped early, the blocks still in flight aren't wanted
+            for future in in_flight:
+                future.cancel()
+
+    def endpoint_stats(self) -> Dict[str, dict]:
+        return {
+            endpoint.url: {"successes": endpoint.successes, "failures": endpoint.failures, "consecutive_failures": endpoint.consecutive_failures}
+            for endpoint in self.endpoints
+        }
+
+
+def fetch_traces(block_numbers: Iterable[int], mode: str, urls: List[str], window: int = 64, batch_size: Optional[int] = None,
+                 compression_level: Optional[int] = None, **fetcher_options):
+    """
+    Synchronous generator over AsyncTraceFetcher.fetch_blocks, for savers.save_to_file.
+    The event loop runs in a background thread, so fetching continues while the caller consumes results.
+    Closing this generator early (e.g. islice, or a failed write) cancels the fetching and closes the session,
+    instead of leaving the loop's thread blocked on a full queue.
+    """
+    results = queue.Queue(window)
+    done = object()
+    errors = []
+    stop = threading.Event()
+    # (loop, task) of produce, for cancelling it from this thread
+    producer = []
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    async def produce():
+        producer.append((asyncio.get_running_loop(), asyncio.current_task()))
+        async with AsyncTraceFetcher(urls, **fetcher_options) as fetcher:
+            blocks = fetcher.fetch_blocks(block_numbers, mode, window, batch_size, compression_level)
+            try:
+                async for result in blocks:
+                    if not await asyncio.get_running_loop().run_in_executor(None, put, result):
+                        return
+            finally:
+                # cancels the blocks in flight before the session closes
+                await blocks.aclose()
+            print(f"endpoint stats: {fetcher.endpoint_stats()}")
+            if fetcher.cache is not None:
+                print(f"trace cache stats: {fetcher.cache.stats()}")
+
+    def run():
+        try:
+            asyncio.run(produce())
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            errors.append(e)
+        finally:
+            put(done)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        while True:
+            result = results.get()
+            if result is done:
+                break
+            yield result
+    finally:
+        stop.set()
+        if len(producer) > 0:
+            loop, task = producer[0]
+            try:
+                loop.call_soon_threadsafe(task.cancel)
+            except RuntimeError:
+                # the loop already finished
+                pass
+        while True:
+            try:
+                results.get_nowait()
+            except queue.Empty:
+                break
+        thread.join()
+    if len(errors) > 0:
+        raise errors[0]
@@ -0,0 +1,161 @@
+import bz2
+import gzip
+import json
+import lzma
+import time
+import zlib
+from typing import List, Optional
+
+import h5py
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# 1: no attributes, json + zlib (files written before codecs were configurable)
+# 2: 'compression', 'level' and 'serializer' attributes on the dataset
+FORMAT_VERSION = 2
+# gzip chunks may be several concatenated members, which lets entries be compressed separately (see gzip_member)
+COMPRESSIONS = ["zlib", "gzip", "lzma", "bz2", "zstd"]
+SERIALIZERS = ["json", "msgpack"]
+
+
+class ChunkCodec:
+    """Serializes + compresses the list of entries stored in one HDF5 chunk, and back."""
+
+    def __init__(self, compression: str = "zlib", level: int = 7, serializer: str = "json", zstd_dictionary: Optional[bytes] = None):
+        if compression not in COMPRESSIONS:
+            raise Exception(f"unknown compression {compression}")
+        if serializer not in SERIALIZERS:
+            raise Exception(f"unknown serializer {serializer}")
+        if compression == "zstd" and zstandard is None:
+            raise Exception("zstd compression needs the zstandard package")
+        if serializer == "msgpack" and msgpack is None:
+            raise Exception("msgpack serialization needs the msgpack package")
+        self.compression = compression
+        self.level = level
+        self.serializer = serializer
+        self.zstd_dictionary = zstd_dictionary
+
+    def __repr__(self) -> str:
+        dictionary = "+dict" if self.zstd_dictionary is not None else ""
+        return f"{self.serializer}/{self.compression}{dictionary}:{self.level}"
+
+    def serialize(self, entries: list) -> bytes:
+        if self.serializer == "msgpack":
+            return msgpack.packb(entries, use_bin_type=True)
+        return json.dumps(entries).encode('ascii')
+
+    def deserialize(self, data: bytes) -> list:
+        if self.serializer == "msgpack":
+            return msgpack.unpackb(data, raw=False, strict_map_key=False)
+        return json.loads(data.decode('utf-8'))
+
+    def compress(self, data: bytes) -> bytes:
+        if self.compression == "gzip":
+            return gzip_member(data, self.level)
+        if self.compression == "lzma":
+            return lzma.compress(data, preset=self.level)
+        if self.compression == "bz2":
+            return bz2.compress(data, self.level)
+        if self.compression == "zstd":
+            dict_data = zstandard.ZstdCompressionDict(self.zstd_dictionary) if self.zstd_dictionary is not None else None
+            return zstandard.ZstdCompressor(level=self.level, dict_data=dict_data).compress(data)
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data: bytes) -> bytes:
+        if self.compression == "gzip":
+            return gzip.decompress(data)
+        if self.compression == "lzma":
+            return lzma.decompress(data)
+        if self.compression == "bz2":
+            return bz2.decompress(data)
+        if self.compression == "zstd":
+            dict_data = zstandard.ZstdCompressionDict(self.zstd_dictionary) if self.zstd_dictionary is not None else None
+            return zstandard.ZstdDecompressor(dict_data=dict_data).decompress(data)
+        return zlib.decompress(data)
+
+    def encode(self, entries: list) -> np.ndarray:
+        return np.frombuffer(self.compress(self.serialize(entries)), dtype=np.uint8)
+
+    def decode(self, chunk) -> list:
+        if len(chunk) == 0:
+            return []
+        return self.deserialize(self.decompress(bytes(chunk)))
+
+    def write_attrs(self, f: h5py.File) -> None:
+        dset = f['dataset']
+        dset.attrs['format_version'] = FORMAT_VERSION
+        dset.attrs['compression'] = self.compression
+        dset.attrs['level'] = self.level
+        dset.attrs['serializer'] = self.serializer
+        if self.zstd_dictionary is not None:
+            f.create_dataset('zstd_dictionary', data=np.frombuffer(self.zstd_dictionary, dtype=np.uint8))
+
+    @staticmethod
+    def from_file(f: h5py.File) -> "ChunkCodec":
+        dset = f['dataset']
+        if dset.attrs.get('format_version', 1) == 1:
+            return ChunkCodec()
+        zstd_dictionary = bytes(f['zstd_dictionary'][:]) if 'zstd_dictionary' in f else None
+        return ChunkCodec(
+            str(dset.attrs['compression']),
+            int(dset.attrs['level']),
+            str(dset.attrs['serializer']),
+            zstd_dictionary,
+        )
+
+
+def gzip_member(data: bytes, level: int = 7) -> bytes:
+    return gzip.compress(data, level, mtime=0)
+
+def gzip_compressobj(level: int = 7):
+    # streaming compressor producing one gzip member
+    return zlib.compressobj(level, zlib.DEFLATED, 31)
+
+def join_gzip_members(members: List[bytes], level: int = 7) -> bytes:
+    # gzip chunk holding the json list of the entries compressed in members
+    separator = gzip_member(b",", level)
+    return gzip_member(b"[", level) + separator.join(members) + gzip_member(b"]", level)
+
+
+def train_zstd_dictionary(filepath: str, dict_size: int = 1 << 17, sample_chunks: int = 32, serializer: str = "json") -> bytes:
+    # trains on the serialized entries of the first chunks of an existing trace file
+    if zstandard is None:
+        raise Exception("zstd compression needs the zstandard package")
+    serializing_codec = ChunkCodec(serializer=serializer)
+    samples = []
+    with h5py.File(filepath, 'r') as f:
+        codec = ChunkCodec.from_file(f)
+        dset = f['dataset']
+        for i_chunk in range(min(sample_chunks, dset.shape[0])):
+            samples.extend(serializing_codec.serialize([entry]) for entry in codec.decode(dset[i_chunk]))
+    return zstandard.train_dictionary(dict_size, samples).as_bytes()
+
+def benchmark_codecs(filepath: str, codecs: List[ChunkCodec], sample_chunks: int = 10) -> None:
+    """Prints the compression ratio and decode throughput of each codec on the first chunks of filepath."""
+    with h5py.File(filepath, 'r') as f:
+        codec = ChunkCodec.from_file(f)
+        dset = f['dataset']
+        chunks = [codec.decode(dset[i_chunk]) for i_chunk in range(min(sample_chunks, dset.shape[0]))]
+    json_size = sum(len(ChunkCodec().serialize(chunk)) for chunk in chunks)
+    for codec in codecs:
+        start = time.perf_counter()
+        encoded = [codec.encode(chunk) for chunk in chunks]
+        encode_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for chunk in encoded:
+            codec.decode(chunk)
+        decode_time = time.perf_counter() - start
+        encoded_size = sum(len(chunk) for chunk in encoded)
+        print(
+            f"{codec}: ratio {json_size / encoded_size:.2f}, "
+            f"encode {json_size / encode_time / 1e6:.1f} MB/s, decode {json_size / decode_time / 1e6:.1f} MB/s"
+        )
@@ -1,10 +1,22 @@
 import queue
-from typing import Any, Callable
+from typing import Any, Callable, Optional
 import requests
-from concurrent.futures import ThreadPoolExecutor
 
 from web3 import Web3
 
+from async_fetchers import fetch_traces
+from trace_cache import TraceCache
+
+CHAINSTACK_RPC_URL = "https://ethereum-mainnet.core.chainstack.com/4033397d5b35d9414e7039efbdae0d45"
+# debug_traceBlockByNumber endpoints, rotated by fetch_parallel
+RPC_URLS = [CHAINSTACK_RPC_URL]
+# when set (see enable_trace_cache), fetch_block_trace and fetch_parallel look traces up here before calling an endpoint
+TRACE_CACHE: Optional[TraceCache] = None
+
+def enable_trace_cache(directory: str, max_bytes: int = 10 << 30) -> TraceCache:
+  global TRACE_CACHE
+  TRACE_CACHE = TraceCache(directory, max_bytes)
+  return TRACE_CACHE
 
 def fetcher_prestate(block_number: int):
   diffFalse = fetch_block_trace(block_number, "prestateTracer", {"diffMode": False})
@@ -16,22 +28,32 @@ def fetcher_call(block_number: int):
   trace = fetch_block_trace(block_number, "callTracer")
   return block_number, trace
 
-def fetch_parallel(iter: int, fetcher: Callable[[int], Any]):    
-    futures = []
-    with ThreadPoolExecutor() as executor:
-        futures = [executor.submit(fetcher, i) for i in iter]
-        for future in futures:
-            result = future.result()
-            if result:
-              yield result
+# fetcher -> async_fetchers fetch mode
+FETCH_MODES = {
+    fetcher_prestate: "prestate",
+    fetcher_call: "call",
+}
+
+def fetch_parallel(iter: int, fetcher: Callable[[int], Any], urls = None, window = 64, batch_size = None, compression_level = None, **fetcher_options):
+    # same (block_number, *traces) results in block order as fetcher, over pooled async connections
+    # with batch_size, all tracer configs of batch_size blocks go in one JSON-RPC batch request
+    # with compression_level, (block_number, compressed entry, complete) for savers.save_compressed_to_file, never decoding the traces
+    fetcher_options.setdefault("cache", TRACE_CACHE)
+    yield from fetch_traces(iter, FETCH_MODES[fetcher], urls if urls is not None else RPC_URLS, window, batch_size, compression_level, **fetcher_options)
 
 
 def fetch_block_trace(block_number: str, tracer_name: str, tracer_config = {}) -> dict:
-    CHAINSTACK_RPC_URL = "https://ethereum-mainnet.core.chainstack.com/4033397d5b35d9414e7039efbdae0d45"
     if tracer_name not in ["callTracer", "prestateTracer"]:
       raise Exception(f"unknown tracer type {tracer_name}")
     if tracer_config not in [{}, {"diffMode": True}, {"diffMode": False}]:
       raise Exception(f"unknown tracer config {tracer_config}")
+    if TRACE_CACHE is not None:
+        try:
+            result = TRACE_CACHE.get(block_number, tracer_name, tracer_config)
+            if result is not None:
+                return result
+        except Exception as e:
+            print(f"Error reading block {block_number} from the trace cache: {e}")
     try:
         payload = {
             "jsonrpc": "2.0",
@@ -45,12 +67,19 @@ def fetch_block_trace(block_number: str, tracer_name: str, tracer_config = {}) -
             ],
             "id": 1
         }
-        response = requests.post(CHAINSTACK_RPC_URL, json=payload, timeout=600)
+        response = requests.post(RPC_URLS[0], json=payload, timeout=600)
         if response.status_code == 200:
             print(f"fetched block trace {block_number} with {tracer_name}, {tracer_config}")
             result = response.json()["result"]
             if result is None:
                 return None
+            if TRACE_CACHE is not None:
+                try:
+                    TRACE_CACHE.put(block_number, tracer_name, tracer_config, result)
+                except Exception as e:
+                    # the trace is fetched, losing its cache entry is fine
+                    print(f"Error caching block {block_number}: {e}")
+            return result
         else:
             print(f"Error tracing block: {response.text}")
     except Exception as e:
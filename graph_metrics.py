@@ -1,14 +1,82 @@
+from functools import cached_property
 from itertools import permutations
 import random
-from typing import Dict
+import signal
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Set, Union
 import networkx as nx
 from networkx.algorithms.community import greedy_modularity_communities
+import numpy as np
+
+import sparse_graph
+from sparse_graph import SparseConflictGraph
+from timing import StageTimer, timed
+
+
+class MetricTimeout(BaseException):
+    # BaseException so the metrics' own "except Exception" handlers don't swallow it
+    pass
+
+# perf_counter deadline of the metric run_metric runs without SIGALRM, see check_metric_deadline
+_metric_deadline: Optional[float] = None
+
+def check_metric_deadline() -> None:
+    # called from the long loops of the metrics, so a budget stops them where SIGALRM can't
+    if _metric_deadline is not None and time.perf_counter() > _metric_deadline:
+        raise MetricTimeout()
+
+class GraphAnalysis:
+    """
+    Per-graph cache of the structures several metrics need, each computed on first use.
+    The clique limits bound the max clique search (see find_max_clique), None searches to optimality.
+    """
+
+    def __init__(self, graph: nx.Graph, clique_node_limit: Optional[int] = None, clique_time_limit: Optional[float] = None):
+        self.graph = graph
+        self.clique_node_limit = clique_node_limit
+        self.clique_time_limit = clique_time_limit
+
+    @cached_property
+    def components(self) -> List[Set]:
+        # largest first
+        return sorted(nx.connected_components(self.graph), key=len, reverse=True)
+
+    @cached_property
+    def degrees(self) -> Dict:
+        return dict(self.graph.degree())
+
+    @cached_property
+    def triangles(self) -> Dict:
+        return nx.triangles(self.graph)
+
+    @cached_property
+    def neighbor_sets(self) -> Dict:
+        return {node: set(neighbors) for node, neighbors in self.graph.adj.items()}
+
+    @cached_property
+    def coloring(self) -> Dict:
+        return nx.coloring.greedy_color(self.graph, strategy="DSATUR")
+
+    @cached_property
+    def max_clique(self):
+        return find_max_clique(self, self.clique_node_limit, self.clique_time_limit)
+
+    @cached_property
+    def critical_path_length(self) -> int:
+        return critical_path_length(self.graph)
+
+def get_analysis(graph) -> GraphAnalysis:
+    return graph if isinstance(graph, GraphAnalysis) else GraphAnalysis(graph)
 
 
 def graph_average_degree(graph):
+    if isinstance(graph, SparseConflictGraph):
+        return sparse_graph.graph_average_degree(graph)
     try:
-        num_edges = graph.number_of_edges()
-        num_nodes = graph.number_of_nodes()
+        G = get_analysis(graph).graph
+        num_edges = G.number_of_edges()
+        num_nodes = G.number_of_nodes()
         if num_nodes == 0:
             return 0.0  # Avoid division by zero if there are no nodes
         avg_degree = (2 * num_edges) / num_nodes
@@ -17,24 +85,32 @@ def graph_average_degree(graph):
         print(f"Exception in graph_average_degree: {e}")
         return float('nan')
 
-def graph_max_degree(graph: nx.Graph):
+def graph_max_degree(graph):
+    if isinstance(graph, SparseConflictGraph):
+        return sparse_graph.graph_max_degree(graph)
     try:
-        return max([val for (node, val) in graph.degree()], default=0)
+        return max(get_analysis(graph).degrees.values(), default=0)
     except Exception as e:
-        print(f"Exception in graph_average_degree: {e}")
+        print(f"Exception in graph_max_degree: {e}")
         return float('nan')
 
 
 def graph_cluster_coe(graph):
     try:
-        return nx.average_clustering(graph)
+        analysis = get_analysis(graph)
+        degrees = analysis.degrees
+        clustering = [
+            2 * triangles / (degrees[node] * (degrees[node] - 1)) if triangles > 0 else 0
+            for node, triangles in analysis.triangles.items()
+        ]
+        return sum(clustering) / len(clustering)
     except Exception as e:
         print(f"Exception in graph_cluster_coe: {e}")
         return float('nan')
 
 def graph_greedy_coloring(graph):
     try:
-        coloring = nx.coloring.greedy_color(graph, strategy="DSATUR")
+        coloring = get_analysis(graph).coloring
         return len(set(coloring.values()))
     except Exception as e:
         print(f"Exception in graph_coloring: {e}")
@@ -42,20 +118,38 @@ def graph_greedy_coloring(graph):
 
 def graph_transitivity(graph):
     try:
-        return nx.transitivity(graph)
+        analysis = get_analysis(graph)
+        triangles = sum(analysis.triangles.values())
+        if triangles == 0:
+            return 0
+        triads = sum(degree * (degree - 1) for degree in analysis.degrees.values())
+        return 2 * triangles / triads
     except Exception as e:
         print(f"Exception in graph_transitivity: {e}")
         return float('nan')
 
 def graph_assortativity(graph):
     try:
-        return nx.degree_assortativity_coefficient(graph)
+        analysis = get_analysis(graph)
+        degrees = analysis.degrees
+        # pearson correlation of the degrees at both ends of every edge, in both directions
+        x = np.array([degrees[u] for u, v in analysis.graph.edges()] + [degrees[v] for u, v in analysis.graph.edges()], dtype=float)
+        y = np.concatenate([x[len(x) // 2:], x[:len(x) // 2]])
+        if len(x) == 0:
+            return float('nan')
+        x = x - x.mean()
+        y = y - y.mean()
+        variance = (x * x).sum() * (y * y).sum()
+        if variance == 0:
+            return float('nan')
+        return float((x * y).sum() / np.sqrt(variance))
     except Exception as e:
         print(f"Exception in graph_assortativity: {e}")
         return float('nan')
 
-def graph_modularity(G):
+def graph_modularity(graph):
     try:
+        G = get_analysis(graph).graph
         communities = list(greedy_modularity_communities(G))
         return nx.algorithms.community.modularity(G, communities)
     except Exception as e:
@@ -63,32 +157,99 @@ def graph_modularity(G):
         return float('nan')
 
 def graph_density(graph):
+    if isinstance(graph, SparseConflictGraph):
+        return sparse_graph.graph_density(graph)
     try:
-        return nx.density(graph)
+        return nx.density(get_analysis(graph).graph)
     except Exception as e:
         print(f"Exception in graph_density: {e}")
         return float('nan')
 
-def graph_diameter(G):
+def graph_diameter(graph):
     try:
-        if nx.is_connected(G):
+        analysis = get_analysis(graph)
+        G = analysis.graph
+        if len(analysis.components) == 1:
             diameter = nx.diameter(G)
         else:
-            diameter = max((nx.diameter(G.subgraph(comp)) for comp in nx.connected_components(G)), default=0)
+            diameter = max((nx.diameter(G.subgraph(comp)) for comp in analysis.components), default=0)
         return diameter
     except Exception as e:
         print(f"Exception in graph_diameter: {e}")
         return float('nan')
 
-def graph_density(G):
+def _bfs(adj, source):
+    # returns (distances, parents), distances in visiting order
+    distances = {source: 0}
+    parents = {source: None}
+    frontier = [source]
+    distance = 0
+    while frontier:
+        check_metric_deadline()
+        distance += 1
+        next_frontier = []
+        for node in frontier:
+            for neighbor in adj[node]:
+                if neighbor not in distances:
+                    distances[neighbor] = distance
+                    parents[neighbor] = node
+                    next_frontier.append(neighbor)
+        frontier = next_frontier
+    return distances, parents
+
+def _eccentricity(adj, source):
+    distances, _ = _bfs(adj, source)
+    return next(reversed(distances.values()))
+
+def component_diameter(adj, comp_nodes, lower_bound=0):
+    """Exact diameter of one connected component via double sweep + iFUB."""
+    # double sweep from the max degree node: a is peripheral, ecc(a) is a lower bound
+    start = max(comp_nodes, key=lambda node: len(adj[node]))
+    distances, _ = _bfs(adj, start)
+    a = next(reversed(distances))
+    distances, parents = _bfs(adj, a)
+    b = next(reversed(distances))
+    lower_bound = max(lower_bound, distances[b])
+    # iFUB from the middle of the a-b path, the node most likely to have small eccentricity
+    middle = b
+    for _ in range(distances[b] // 2):
+        middle = parents[middle]
+    distances, _ = _bfs(adj, middle)
+    levels: Dict[int, List] = {}
+    for node, distance in distances.items():
+        levels.setdefault(distance, []).append(node)
+    i = max(levels)
+    lower_bound = max(lower_bound, i)
+    upper_bound = 2 * i
+    while upper_bound > lower_bound:
+        fringe_eccentricity = max(_eccentricity(adj, node) for node in levels[i])
+        lower_bound = max(lower_bound, fringe_eccentricity)
+        if lower_bound > 2 * (i - 1):
+            break
+        upper_bound = 2 * (i - 1)
+        i -= 1
+    return lower_bound
+
+def graph_diameter_ifub(graph):
     try:
-        return nx.density(G)
+        analysis = get_analysis(graph)
+        adj = analysis.graph.adj
+        diameter = 0
+        for comp_nodes in analysis.components:
+            # a component of n nodes has diameter at most n - 1
+            if len(comp_nodes) - 1 <= diameter:
+                break
+            diameter = max(diameter, component_diameter(adj, comp_nodes, diameter))
+        return diameter
     except Exception as e:
-        print(f"Exception in graph_conflict_percentage: {e}")
+        print(f"Exception in graph_diameter_ifub: {e}")
         return float('nan')
 
-def graph_conflict_percentage(G):
+def graph_conflict_percentage(graph):
+    if isinstance(graph, SparseConflictGraph):
+        return sparse_graph.graph_conflict_percentage(graph)
     try:
+        G = get_analysis(graph).graph
         num_nodes = G.number_of_nodes()
         num_edges = G.number_of_edges()
         max_possible_edges = num_nodes * (num_nodes - 1) / 2
@@ -99,16 +260,18 @@ def graph_conflict_percentage(G):
         return float('nan')
 
 
-def graph_longest_path_length(G):
+def graph_longest_path_length(graph):
     try:
-        components = sorted(nx.connected_components(G), key=len, reverse=True)
+        analysis = get_analysis(graph)
+        G = analysis.graph
         longest_path_length = 0
-        for comp_nodes in components:
+        for comp_nodes in analysis.components:
             comp_size = len(comp_nodes)
             if comp_size <= longest_path_length:
                 break
             sampled_nodes = random.sample(list(comp_nodes), max(1, comp_size // 10))
             for source_node in sampled_nodes:
+                check_metric_deadline()
                 seen_nodes = {source_node}
                 curr_node = source_node
                 path_length = 1
@@ -126,14 +289,47 @@ def graph_longest_path_length(G):
         print(f"Exception in graph_longest_path_length: {e}")
         return float('nan')
 
+def critical_path_length(G: nx.Graph) -> int:
+    """
+    Number of txs on the longest chain of conflicts, each edge oriented from the earlier tx to the later one.
+    Nodes are in block order (see create_conflict_graph), which is a topological order of the oriented edges,
+    so one pass over it, O(V + E), gives every tx the longest chain ending at it.
+    """
+    position = {node: i for i, node in enumerate(G)}
+    chain = {}
+    for node in G:
+        chain[node] = 1 + max((chain[neighbor] for neighbor in G.adj[node] if position[neighbor] < position[node]), default=0)
+    return max(chain.values(), default=0)
+
+def graph_critical_path_length(graph):
+    if isinstance(graph, SparseConflictGraph):
+        return sparse_graph.graph_critical_path_length(graph)
+    try:
+        return get_analysis(graph).critical_path_length
+    except Exception as e:
+        print(f"Exception in graph_critical_path_length: {e}")
+        return float('nan')
+
+def graph_parallel_speedup_bound(graph):
+    # txs over the critical path: no schedule of the block's txs in conflict order can beat it
+    if isinstance(graph, SparseConflictGraph):
+        return sparse_graph.graph_parallel_speedup_bound(graph)
+    try:
+        analysis = get_analysis(graph)
+        if analysis.critical_path_length == 0:
+            return float('nan')
+        return analysis.graph.number_of_nodes() / analysis.critical_path_length
+    except Exception as e:
+        print(f"Exception in graph_parallel_speedup_bound: {e}")
+        return float('nan')
+
 # instead make a random path!
-def graph_largest_connected_component_size(G):
+def graph_largest_connected_component_size(graph):
+    if isinstance(graph, SparseConflictGraph):
+        return sparse_graph.graph_largest_connected_component_size(graph)
     try:
-        components = nx.connected_components(G)
-        largest_size = max((len(component) for component in components), default=0)
-        if largest_size == nx.number_of_nodes(G):
-            x = 3
-        return largest_size
+        components = get_analysis(graph).components
+        return len(components[0]) if len(components) > 0 else 0
     except Exception as e:
         print(f"Exception in graph_largest_connected_component_size: {e}")
         return float('nan')
@@ -141,36 +337,217 @@ def graph_largest_connected_component_size(G):
 def graph_clique(graph):
     try:
          # Find all maximal cliques
-        maximal_cliques = nx.find_cliques(graph)
+        maximal_cliques = nx.find_cliques(get_analysis(graph).graph)
         
         # Determine the size of the largest clique
-        max_clique_size = max((len(clique) for clique in maximal_cliques), default=0)
+        max_clique_size = 0
+        for clique in maximal_cliques:
+            check_metric_deadline()
+            max_clique_size = max(max_clique_size, len(clique))
         
         return max_clique_size
     except Exception as e:
         print(f"Exception in graph_clique_number: {e}")
         return float('nan')
 
+class _CliqueSearchStop(Exception):
+    pass
+
+def _color_sort(adj, candidates):
+    # greedy sequential coloring, returns the candidates ordered by color with each one's color number
+    color_classes = []
+    for node in candidates:
+        for color_class in color_classes:
+            if adj[node].isdisjoint(color_class):
+                color_class.append(node)
+                break
+        else:
+            color_classes.append([node])
+    order = []
+    colors = []
+    for color, color_class in enumerate(color_classes, 1):
+        order.extend(color_class)
+        colors.extend([color] * len(color_class))
+    return order, colors
+
+def find_max_clique(graph, node_limit: Optional[int] = None, time_limit: Optional[float] = None):
+    """
+    Branch and bound maximum clique (MCQ style), pruned with greedy coloring bounds.
+    Returns (clique, lower_bound, upper_bound); the bounds differ only if a limit stopped the search.
+    """
+    analysis = get_analysis(graph)
+    adj = analysis.neighbor_sets
+    coloring = analysis.coloring
+    deadline = time.perf_counter() + time_limit if time_limit is not None else None
+    best = []
+    expanded = 0
+    # the number of DSATUR colors in a component bounds its clique number
+    component_bounds = [(comp_nodes, len({coloring[node] for node in comp_nodes})) for comp_nodes in analysis.components]
+
+    def expand(clique, candidates, bound):
+        nonlocal best, expanded
+        expanded += 1
+        check_metric_deadline()
+        if (node_limit is not None and expanded > node_limit) or (deadline is not None and time.perf_counter() > deadline):
+            raise _CliqueSearchStop()
+        order, colors = _color_sort(adj, candidates)
+        for i in range(len(order) - 1, -1, -1):
+            if len(clique) + colors[i] <= len(best):
+                return
+            node = order[i]
+            new_candidates = [candidate for candidate in order[:i] if candidate in adj[node]]
+            if len(new_candidates) == 0:
+                if len(clique) + 1 > len(best):
+                    best = clique + [node]
+                    if len(best) == bound:
+                        raise _CliqueSearchStop()
+            else:
+                expand(clique + [node], new_candidates, bound)
+
+    upper_bound = 0
+    for i_comp, (comp_nodes, bound) in enumerate(component_bounds):
+        if bound <= len(best):
+            continue
+        candidates = sorted(comp_nodes, key=lambda node: len(adj[node]), reverse=True)
+        try:
+            expand([], candidates, bound)
+        except _CliqueSearchStop:
+            if len(best) < bound:
+                # stopped by a limit, the unsearched components can still hold a bigger clique
+                upper_bound = max(bound for _, bound in component_bounds[i_comp:])
+                break
+    return best, len(best), max(upper_bound, len(best))
+
+def graph_max_clique(graph):
+    try:
+        _, lower_bound, _ = get_analysis(graph).max_clique
+        return lower_bound
+    except Exception as e:
+        print(f"Exception in graph_max_clique: {e}")
+        return float('nan')
+
+def graph_clique_upper_bound(graph):
+    try:
+        _, _, upper_bound = get_analysis(graph).max_clique
+        return upper_bound
+    except Exception as e:
+        print(f"Exception in graph_clique_upper_bound: {e}")
+        return float('nan')
+
 def get_call_metrics(trace: dict) -> Dict[str, float]:
     results = {
     }
     return results
 
-def get_graph_metrics(graph: nx.Graph, additional_metrics = {}) -> Dict[str, float]:
-    results = {
-        "degree": graph_average_degree(graph),
-        "greedy_color": graph_greedy_coloring(graph),
-        "assortativity": graph_assortativity(graph),
-        "cluster_coe": graph_cluster_coe(graph),
-        "density": graph_density(graph),
-        "modularity": graph_modularity(graph),
-        "transitivity": graph_transitivity(graph),
-        "diameter": graph_diameter(graph),
-        "clique_number": graph_clique(graph),
-        "density": graph_density(graph),
-        "largest_conn_comp": graph_largest_connected_component_size(graph),
-        "longest_path_length_monte_carlo": graph_longest_path_length(graph),
-        "max_degree": graph_max_degree(graph)
-    }
+# metric name -> (tier, function), in output column order
+GRAPH_METRICS = {
+    "degree": ("cheap", graph_average_degree),
+    "greedy_color": ("medium", graph_greedy_coloring),
+    "assortativity": ("medium", graph_assortativity),
+    "cluster_coe": ("medium", graph_cluster_coe),
+    "density": ("cheap", graph_density),
+    "modularity": ("expensive", graph_modularity),
+    "transitivity": ("medium", graph_transitivity),
+    "diameter": ("medium", graph_diameter_ifub),
+    "clique_number": ("expensive", graph_max_clique),
+    "largest_conn_comp": ("cheap", graph_largest_connected_component_size),
+    "longest_path_length_monte_carlo": ("medium", graph_longest_path_length),
+    "critical_path_length": ("cheap", graph_critical_path_length),
+    "parallel_speedup_bound": ("cheap", graph_parallel_speedup_bound),
+    "max_degree": ("cheap", graph_max_degree),
+    "conflict_percentage": ("cheap", graph_conflict_percentage),
+    "diameter_networkx": ("expensive", graph_diameter),
+    "clique_upper_bound": ("expensive", graph_clique_upper_bound),
+    "clique_number_networkx": ("expensive", graph_clique),
+}
+METRIC_TIERS = ["cheap", "medium", "expensive"]
+DEFAULT_METRICS = [
+    name for name in GRAPH_METRICS
+    if name not in ("conflict_percentage", "diameter_networkx", "clique_upper_bound", "clique_number_networkx")
+]
+# metrics that can run on a SparseConflictGraph without converting it to networkx
+SPARSE_METRICS = {"degree", "density", "largest_conn_comp", "max_degree", "conflict_percentage", "critical_path_length", "parallel_speedup_bound"}
+
+def select_metrics(selection: Optional[Iterable[str]] = None):
+    # selection entries are metric names or tier names, None selects the default metrics
+    if selection is None:
+        return list(DEFAULT_METRICS)
+    selected = set()
+    for name in selection:
+        if name in METRIC_TIERS:
+            selected.update(metric for metric, (tier, _) in GRAPH_METRICS.items() if tier == name)
+        elif name in GRAPH_METRICS:
+            selected.add(name)
+        else:
+            raise Exception(f"unknown metric {name}")
+    return [name for name in GRAPH_METRICS if name in selected]
+
+def get_metric_budget(name: str, budgets: Union[None, float, Dict[str, float]]):
+    # budgets is a single number of seconds for every metric, or a dict keyed by metric or tier name
+    if budgets is None or isinstance(budgets, (int, float)):
+        return budgets
+    tier, _ = GRAPH_METRICS[name]
+    return budgets.get(name, budgets.get(tier))
+
+def _raise_metric_timeout(signum, frame):
+    raise MetricTimeout()
+
+def run_metric(func, graph, budget: Optional[float]):
+    """
+    Runs func(graph), returning (value, timed_out). Over budget the value is NaN.
+    With SIGALRM (POSIX main thread) the metric is interrupted wherever it is. Without it (Windows, other threads)
+    the budget is enforced cooperatively: the diameter, clique and longest path searches check the deadline and stop,
+    while a metric spending its budget inside networkx (modularity, coloring, clustering, ...) runs to completion
+    and is only then reported as timed out.
+    """
+    if budget is None:
+        return func(graph), False
+    if hasattr(signal, "setitimer") and threading.current_thread() is threading.main_thread():
+        previous_handler = signal.signal(signal.SIGALRM, _raise_metric_timeout)
+        try:
+            signal.setitimer(signal.ITIMER_REAL, budget)
+            try:
+                return func(graph), False
+            finally:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+        except MetricTimeout:
+            return float('nan'), True
+        finally:
+            signal.signal(signal.SIGALRM, previous_handler)
+    global _metric_deadline
+    start = time.perf_counter()
+    _metric_deadline = start + budget
+    try:
+        value = func(graph)
+    except MetricTimeout:
+        return float('nan'), True
+    finally:
+        _metric_deadline = None
+    if time.perf_counter() - start > budget:
+        return float('nan'), True
+    return value, False
+
+def get_graph_metrics(graph, additional_metrics = {}, metrics: Optional[Iterable[str]] = None, budgets: Union[None, float, Dict[str, float]] = None, timer: Optional[StageTimer] = None,
+                      clique_node_limit: Optional[int] = None, clique_time_limit: Optional[float] = None) -> Dict[str, float]:
+    analysis = None
+    results = {}
+    timed_out = []
+    for name in select_metrics(metrics):
+        _, func = GRAPH_METRICS[name]
+        if isinstance(graph, SparseConflictGraph) and name in SPARSE_METRICS:
+            metric_graph = graph
+        else:
+            # the cheap metrics run on the sparse backend directly, the rest share one networkx analysis
+            if analysis is None:
+                analysis = GraphAnalysis(
+                    graph.to_networkx() if isinstance(graph, SparseConflictGraph) else graph, clique_node_limit, clique_time_limit,
+                )
+            metric_graph = analysis
+        with timed(timer, name):
+            results[name], is_timed_out = run_metric(func, metric_graph, get_metric_budget(name, budgets))
+        if is_timed_out:
+            timed_out.append(name)
+    if budgets is not None:
+        results["timed_out"] = ";".join(timed_out)
     results.update(additional_metrics)
     return results
\ No newline at end of file
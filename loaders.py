@@ -1,52 +1,118 @@
+from collections import deque
+from itertools import islice
 import json
 import os
 import pickle
-import zlib
+import time
 
+from typing import Optional
 import h5py
 
+from chunk_codecs import ChunkCodec
 from parsers import apply_recursively, bytes_to_hex
 from concurrent.futures import ThreadPoolExecutor
 
-def uncompress_chunk(dset, i):
-    chunk = dset[i]
-    if len(chunk) == 0:
-        return []
-    chunk = bytes(chunk)
-    chunk = zlib.decompress(chunk)
-    chunk = chunk.decode('ascii')
-    chunk = json.loads(chunk)
-    return chunk
-
-def load_compressed_file(filepath: str, limit=None):
+def uncompress_chunk(dset, i, codec: Optional[ChunkCodec] = None):
+    if codec is None:
+        codec = ChunkCodec.from_file(dset.file)
+    return codec.decode(dset[i])
+
+def timed_uncompress_chunk(dset, i, codec: Optional[ChunkCodec] = None):
+    start = time.perf_counter()
+    chunk = uncompress_chunk(dset, i, codec)
+    return chunk, time.perf_counter() - start
+
+def load_compressed_file(filepath: str, limit=None, timed=False, skip_blocks=None):
+    # with timed, yields (entry, seconds) pairs, seconds being the entry's share of its chunk's decode time
+    # entries whose block number is in skip_blocks are dropped, indexed chunks holding only such blocks aren't decoded
     if os.path.exists(filepath):
         with h5py.File(filepath, 'r') as f:
             dset = f['dataset']
+            codec = ChunkCodec.from_file(f)
             i_entry = 0
-            chunk_count = dset.shape[0]
+            chunks = range(dset.shape[0])
+            if skip_blocks and 'index' in f:
+                chunks = sorted({int(i_chunk) for block_number, i_chunk, _ in f['index'][:] if int(block_number) not in skip_blocks})
+            superseded = load_superseded_entries(f)
+            chunks = iter(chunks)
             max_pending = 2
             with ThreadPoolExecutor(max_pending) as pool:
-                futures = [
-                    pool.submit(uncompress_chunk, dset, i_chunk) 
-                    for i_chunk in range(min(max_pending, chunk_count))
-                ]
-                i_chunk = len(futures)
+                futures = deque(
+                    (i_chunk, pool.submit(timed_uncompress_chunk, dset, i_chunk, codec))
+                    for i_chunk in islice(chunks, max_pending)
+                )
                 while len(futures) > 0:
-                    future = futures[0]
-                    futures = futures[1:]
-                    entries = future.result()
-                    for entry in entries:
+                    i_chunk, future = futures.popleft()
+                    entries, decode_time = future.result()
+                    for offset, entry in enumerate(entries):
+                        if skip_blocks and entry[0] in skip_blocks:
+                            continue
+                        if (i_chunk, offset) in superseded:
+                            continue
                         i_entry += 1
                         print(f"loaded {i_entry} values from {filepath}")
-                        yield entry
+                        yield (entry, decode_time / len(entries)) if timed else entry
                         if i_entry == limit:
                             return
-                    if i_chunk < chunk_count:
-                        futures.append(pool.submit(uncompress_chunk, dset, i_chunk))
-                        i_chunk += 1
+                    i_chunk = next(chunks, None)
+                    if i_chunk is not None:
+                        futures.append((i_chunk, pool.submit(timed_uncompress_chunk, dset, i_chunk, codec)))
     else:
         print("No traces file found.")
 
+def load_superseded_entries(f: h5py.File):
+    # (chunk, offset) of the entries of blocks saved again later in the file, e.g. by savers.repair_files
+    if 'index' not in f:
+        return set()
+    latest = {}
+    for block_number, i_chunk, offset in f['index'][:]:
+        latest[int(block_number)] = (int(i_chunk), int(offset))
+    if len(latest) == f['index'].shape[0]:
+        return set()
+    return {(int(i_chunk), int(offset)) for _, i_chunk, offset in f['index'][:]} - set(latest.values())
+
+def load_chunk(filepath: str, i_chunk: int, timed=False):
+    # opens the file itself, so a worker process can be handed just (filepath, i_chunk)
+    with h5py.File(filepath, 'r') as f:
+        entries, decode_time = timed_uncompress_chunk(f['dataset'], i_chunk, ChunkCodec.from_file(f))
+    return (entries, decode_time) if timed else entries
+
+def load_chunk_block_numbers(filepath: str):
+    # chunk -> block numbers in it, None for files without an index
+    with h5py.File(filepath, 'r') as f:
+        if 'index' not in f:
+            return None
+        chunk_block_numbers = {}
+        for block_number, i_chunk, _ in f['index'][:]:
+            chunk_block_numbers.setdefault(int(i_chunk), []).append(int(block_number))
+        return chunk_block_numbers
+
+def load_index(filepath: str):
+    # block_number -> (chunk, offset in chunk), see savers.build_index for files without an index
+    with h5py.File(filepath, 'r') as f:
+        if 'index' not in f:
+            raise Exception(f"{filepath} has no block index, build it with savers.build_index")
+        return {int(block_number): (int(i_chunk), int(offset)) for block_number, i_chunk, offset in f['index'][:]}
+
+def load_blocks(filepath: str, block_numbers, timed=False):
+    # decompresses only the chunks holding block_numbers (any iterable, e.g. a range), yields entries in file order
+    # with timed, yields (entry, seconds) pairs like load_compressed_file
+    index = load_index(filepath)
+    chunk_offsets = {}
+    for block_number in block_numbers:
+        if block_number not in index:
+            print(f"block {block_number} is not in {filepath}")
+            continue
+        i_chunk, offset = index[block_number]
+        chunk_offsets.setdefault(i_chunk, []).append(offset)
+    with h5py.File(filepath, 'r') as f:
+        dset = f['dataset']
+        codec = ChunkCodec.from_file(f)
+        for i_chunk in sorted(chunk_offsets):
+            entries, decode_time = timed_uncompress_chunk(dset, i_chunk, codec)
+            for offset in sorted(chunk_offsets[i_chunk]):
+                yield (entries[offset], decode_time / len(entries)) if timed else entries[offset]
+
 def load_file(filepath: str, limit=None):
     if os.path.exists(filepath):
         with h5py.File(filepath, 'r') as f:
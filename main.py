@@ -1,4 +1,6 @@
-import csv
+import argparse
+from contextlib import closing
+from functools import partial
 from itertools import islice
 import json
 import os
@@ -8,96 +10,443 @@ from matplotlib import pyplot as plt
 import pandas as pd
 import networkx as nx
 import multiprocessing as mp
+import queue
+import shutil
+import threading
 
 from fetchers import fetch_block, fetch_block_trace, fetch_parallel, fetcher_prestate, fetcher_call
-from parsers import create_conflict_graph, get_callTracer_additional_metrics, parse_callTracer_trace, parse_preStateTracer_trace
+from parsers import CALL_METRIC_COLUMNS, KeyInterner, create_conflict_graph, from_parsed_block, parse_call_block, parse_callTracer_block, parse_preStateTracer_trace, parse_prestate_block
 from graph_metrics import *
+from sparse_graph import create_sparse_conflict_graph
+from timing import StageTimer, timed
+from sinks import open_sink
 
 from plotters import plot_data
 import plotters
-from savers import append_to_file, save_prestate, save_to_file
+from savers import append_to_file, build_index, repair_files, save_compressed_to_file, save_prestate, save_to_file
 
-from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy.interpolate import griddata
-from loaders import load_compressed_file, load_file
+from loaders import load_blocks, load_chunk, load_chunk_block_numbers, load_compressed_file, load_file, load_index
 
-def process_prestate_trace(block_number, diffFalse, diffTrue):
+GRAPH_BACKENDS = {
+    "networkx": create_conflict_graph,
+    "sparse": create_sparse_conflict_graph,
+}
+
+def process_prestate_trace(block_number, diffFalse, diffTrue, graph_backend="networkx", metrics=None, budgets=None, timings=False, trace_memory=False,
+                           storage_slots=False, clique_node_limit=None, clique_time_limit=None):
     print(f"processing {block_number}...")
     if diffFalse is None or diffTrue is None:
         print(f"{block_number} data is missing!")
         return None
-    reads, writes = parse_preStateTracer_trace(diffFalse, diffTrue)
-    txs = [tx_trace["txHash"] for tx_trace in diffFalse]
-    G = create_conflict_graph(txs, reads, writes)
-    return get_graph_metrics(G, {"block_number": block_number, "txs": len(diffFalse)})
+    timer = StageTimer(trace_memory) if timings else None
+    with timed(timer, "parse"):
+        reads, writes = parse_preStateTracer_trace(diffFalse, diffTrue, KeyInterner(), storage_slots)
+        txs = [tx_trace["txHash"] for tx_trace in diffFalse]
+    with timed(timer, "graph"):
+        G = GRAPH_BACKENDS[graph_backend](txs, reads, writes)
+    results = get_graph_metrics(G, {"block_number": block_number, "txs": len(diffFalse)}, metrics, budgets, timer, clique_node_limit, clique_time_limit)
+    if timer is not None:
+        results.update(timer.columns)
+    return results
 
-def process_call_trace(block_number, call_trace):
+def process_call_trace(block_number, call_trace, graph_backend="networkx", metrics=None, budgets=None, timings=False, trace_memory=False,
+                       clique_node_limit=None, clique_time_limit=None):
     print(f"processing {block_number}...")
     if call_trace is None:
         print(f"{block_number} data is missing!")
         return None
-    metrics = {}
-    metrics.update(get_callTracer_additional_metrics(call_trace))
-    reads, writes = parse_callTracer_trace(call_trace)
-    txs = [tx_trace["txHash"] for tx_trace in call_trace]
-    G = create_conflict_graph(txs, reads, writes)
-    metrics.update(get_graph_metrics(G, {"block_number": block_number, "txs": len(call_trace)}))
-    return metrics
-
-def generate_data(data_path, output_path, processor, limit = None):
-    write_header = not os.path.exists(output_path)
-    max_pending = 1000
-    with open(output_path, mode="a", newline="") as file:
-        with ProcessPoolExecutor() as pool:
-            data_generator = load_compressed_file(data_path, limit)
-            futures = [
-                pool.submit(processor, *data) for data in islice(data_generator, max_pending)
-            ]
-            all_submitted = len(futures) < max_pending
-            writer = csv.writer(file)
+    timer = StageTimer(trace_memory) if timings else None
+    with timed(timer, "parse"):
+        results, reads, writes = parse_callTracer_block(call_trace, KeyInterner())
+        txs = [tx_trace["txHash"] for tx_trace in call_trace]
+    with timed(timer, "graph"):
+        G = GRAPH_BACKENDS[graph_backend](txs, reads, writes)
+    results.update(get_graph_metrics(G, {"block_number": block_number, "txs": len(call_trace)}, metrics, budgets, timer, clique_node_limit, clique_time_limit))
+    if timer is not None:
+        results.update(timer.columns)
+    return results
+
+def process_parsed_block(block_number, txs, keys, reads, writes, additional_metrics, graph_backend="networkx", metrics=None, budgets=None, timings=False, trace_memory=False,
+                         clique_node_limit=None, clique_time_limit=None):
+    # same output as process_prestate_trace / process_call_trace, from a parse cache entry
+    print(f"processing {block_number}...")
+    timer = StageTimer(trace_memory) if timings else None
+    results = dict(additional_metrics)
+    with timed(timer, "parse"):
+        reads, writes = from_parsed_block(txs, reads, writes)
+    with timed(timer, "graph"):
+        G = GRAPH_BACKENDS[graph_backend](txs, reads, writes)
+    results.update(get_graph_metrics(G, {"block_number": block_number, "txs": len(txs)}, metrics, budgets, timer, clique_node_limit, clique_time_limit))
+    if timer is not None:
+        results.update(timer.columns)
+    return results
+
+# raw trace processor -> parser producing its parse cache entries
+BLOCK_PARSERS = {
+    process_prestate_trace: parse_prestate_block,
+    process_call_trace: parse_call_block,
+}
+PARSED_CACHE_SUFFIX = "_parsed.h5"
+
+def get_parsed_cache_path(data_path):
+    return os.path.splitext(data_path)[0] + PARSED_CACHE_SUFFIX
+
+def build_parsed_cache(data_path, processor, limit = None):
+    # stores the parsed read/write sets of every block of data_path next to it, for generate_data to reuse
+    block_parser = BLOCK_PARSERS[processor]
+    batch_size = 256
+    def parse_batches(pool, data_generator):
+        # bounded batches, pool.map alone would pull in the whole file before yielding
+        while True:
+            batch = list(islice(data_generator, batch_size))
+            if len(batch) == 0:
+                return
+            for block in pool.map(block_parser, *zip(*batch), chunksize=16):
+                if block is not None:
+                    yield block
+    with ProcessPoolExecutor() as pool:
+        save_to_file(get_parsed_cache_path(data_path), parse_batches(pool, load_compressed_file(data_path, limit)))
+    with h5py.File(get_parsed_cache_path(data_path), 'a') as f:
+        # what the cache was built from, see is_parsed_cache_current
+        f.attrs['source_mtime'] = os.path.getmtime(data_path)
+        f.attrs['complete'] = limit is None
+
+def is_parsed_cache_current(data_path):
+    # a cache built with a limit, or before data_path was appended to or repaired, misses blocks
+    parsed_cache_path = get_parsed_cache_path(data_path)
+    with h5py.File(parsed_cache_path, 'r') as f:
+        if 'source_mtime' in f.attrs:
+            return bool(f.attrs['complete']) and f.attrs['source_mtime'] == os.path.getmtime(data_path)
+    # built before the attrs were recorded
+    return os.path.getmtime(parsed_cache_path) >= os.path.getmtime(data_path)
+
+def get_parsed_processor(processor):
+    # maps a (possibly partial) raw trace processor onto process_parsed_block with the same options
+    keywords = {}
+    if isinstance(processor, partial):
+        keywords = dict(processor.keywords)
+        processor = processor.func
+    if processor not in BLOCK_PARSERS or keywords.pop("storage_slots", False):
+        # parse caches hold account keys
+        return None
+    return partial(process_parsed_block, **keywords)
+
+def get_output_columns(processor, timings = False):
+    # the explicit output schema of a (possibly partial) block processor, in the column order it produces
+    keywords = {}
+    if isinstance(processor, partial):
+        keywords = processor.keywords
+        processor = processor.func
+    metrics = select_metrics(keywords.get("metrics"))
+    call_tracer = processor is process_call_trace
+    columns = list(CALL_METRIC_COLUMNS) if call_tracer else []
+    columns += metrics
+    if keywords.get("budgets") is not None:
+        columns.append("timed_out")
+    columns += ["block_number", "txs"]
+    if timings:
+        stages = ["parse", "graph"] + metrics
+        columns += [f"t_{stage}" for stage in stages]
+        if keywords.get("trace_memory"):
+            columns += [f"m_{stage}" for stage in stages]
+        columns.append("t_decode")
+    return columns
+
+def process_batch(processor, batch):
+    # batch holds (data, decode_time) pairs decoded by the parent
+    return [(processor(*data), decode_time) for data, decode_time in batch]
+
+def process_chunk(processor, data_path, i_chunk, skip_blocks, block_range):
+    # decodes the chunk in the worker, so only the descriptor and the metrics cross the process boundary
+    entries, decode_time = load_chunk(data_path, i_chunk, timed=True)
+    decode_time /= max(len(entries), 1)
+    return [
+        (processor(*entry), decode_time) for entry in entries
+        if entry[0] not in skip_blocks and (block_range is None or entry[0] in block_range)
+    ]
+
+def batch_blocks(data_generator, batch_txs):
+    # groups (data, decode_time) pairs into tasks of about batch_txs transactions, data[1] being the block's tx list
+    batch = []
+    batch_size = 0
+    for data, decode_time in data_generator:
+        batch.append((data, decode_time))
+        batch_size += len(data[1]) if data[1] is not None else 0
+        if batch_size >= batch_txs:
+            yield batch
+            batch = []
+            batch_size = 0
+    if len(batch) > 0:
+        yield batch
+
+def run_tasks(pool, tasks, window, ordered=True):
+    """
+    Runs (function, *args) tasks on the pool, with at most window tasks in flight.
+    Each task returns (result, decode_time) pairs, yielded in task order or as tasks complete.
+    """
+    in_flight = deque(pool.submit(*task) for task in islice(tasks, window))
+    while len(in_flight) > 0:
+        if ordered:
+            future = in_flight.popleft()
+        else:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            future = next(future for future in in_flight if future in done)
+            in_flight.remove(future)
+        results = future.result()
+        next_task = next(tasks, None)
+        if next_task is not None:
+            in_flight.append(pool.submit(*next_task))
+        yield from results
+
+def get_file_processor(data_path, processor, timings, use_parsed_cache):
+    # reads the parse cache of data_path instead when there is one
+    parsed_processor = get_parsed_processor(processor)
+    if use_parsed_cache and parsed_processor is not None and os.path.exists(get_parsed_cache_path(data_path)):
+        if is_parsed_cache_current(data_path):
+            print(f"reading parsed blocks of {data_path} from its parse cache")
+            data_path = get_parsed_cache_path(data_path)
+            processor = parsed_processor
+        else:
+            print(f"the parse cache of {data_path} is out of date, reading its traces instead")
+    if timings:
+        processor = partial(processor, timings=True)
+    return data_path, processor
+
+def ensure_index(data_path):
+    # trace files saved before the index existed get one the first time a block range or chunk tasks need it
+    with h5py.File(data_path, 'r') as f:
+        indexed = 'index' in f
+    if not indexed:
+        print(f"{data_path} has no block index, building it")
+        build_index(data_path)
+
+def load_file_tasks(data_path, processor, block_range = None, limit = None, timings = False, use_parsed_cache = True,
+                    skip_blocks = set(), batch_txs = 2000):
+    # yields the process_batch tasks of one trace file, decoded in this process
+    data_path, processor = get_file_processor(data_path, processor, timings, use_parsed_cache)
+    if block_range is not None:
+        ensure_index(data_path)
+        block_numbers = [block_number for block_number in load_index(data_path) if block_number in block_range and block_number not in skip_blocks]
+        data_generator = islice(load_blocks(data_path, block_numbers, timed=True), limit)
+    else:
+        data_generator = load_compressed_file(data_path, limit, timed=True, skip_blocks=skip_blocks)
+    for batch in batch_blocks(data_generator, batch_txs):
+        yield process_batch, processor, batch
+
+def load_file_chunk_tasks(data_path, processor, block_range = None, timings = False, use_parsed_cache = True, skip_blocks = set()):
+    # yields one process_chunk task per chunk of data_path holding blocks still to process
+    data_path, processor = get_file_processor(data_path, processor, timings, use_parsed_cache)
+    # without an index every task would carry the whole skip_blocks set, index the file once instead
+    ensure_index(data_path)
+    chunk_block_numbers = load_chunk_block_numbers(data_path)
+    for i_chunk, block_numbers in sorted(chunk_block_numbers.items()):
+        chunk_skip_blocks = {block_number for block_number in block_numbers if block_number in skip_blocks}
+        if block_range is not None:
+            block_numbers = [block_number for block_number in block_numbers if block_number in block_range]
+        if any(block_number not in chunk_skip_blocks for block_number in block_numbers):
+            yield process_chunk, processor, data_path, i_chunk, chunk_skip_blocks, block_range
+
+def read_concurrently(generators, readers, max_queued):
+    # runs up to readers generators in threads, yielding their items as they come
+    # closing this generator early (e.g. a failed task) stops the readers instead of leaving them blocked on a full queue
+    items = queue.Queue(max_queued)
+    done = object()
+    stop = threading.Event()
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    def read(generator):
+        try:
+            for item in generator:
+                if not put(item):
+                    return
+        finally:
+            put(done)
+    with ThreadPoolExecutor(readers) as pool:
+        futures = [pool.submit(read, generator) for generator in generators]
+        try:
+            remaining = len(futures)
+            while remaining > 0:
+                item = items.get()
+                if item is done:
+                    remaining -= 1
+                else:
+                    yield item
+            for future in futures:
+                future.result()
+        finally:
+            stop.set()
+            while True:
+                try:
+                    items.get_nowait()
+                except queue.Empty:
+                    break
+
+def generate_data_files(shards, output_path, processor, limit = None, timings = False, use_parsed_cache = True, resume = True,
+                        workers = None, window = 64, batch_txs = 2000, ordered = True, readers = 2, worker_decode = False):
+    """
+    Processes (data_path, block_range or None) shards into one output, over a single process pool.
+    readers files are decoded concurrently; blocks go to the pool in tasks of about batch_txs txs,
+    at most window tasks in flight. With worker_decode, the workers get (file, chunk) descriptors
+    and decode the chunks themselves instead. With timings, rows also get t_<stage> columns.
+    """
+    if worker_decode and limit is not None:
+        raise Exception("limit is not supported with worker_decode")
+    sink = open_sink(output_path, get_output_columns(processor, timings))
+    completed_blocks = set()
+    if resume:
+        completed_blocks = sink.completed_blocks()
+        print(f"skipping {len(completed_blocks)} blocks already in {output_path}")
+    if worker_decode:
+        file_tasks = [
+            load_file_chunk_tasks(data_path, processor, block_range, timings, use_parsed_cache, completed_blocks)
+            for data_path, block_range in shards
+        ]
+    else:
+        file_tasks = [
+            load_file_tasks(data_path, processor, block_range, limit, timings, use_parsed_cache, completed_blocks, batch_txs)
+            for data_path, block_range in shards
+        ]
+    try:
+        with ProcessPoolExecutor(workers) as pool, closing(read_concurrently(file_tasks, readers, window)) as tasks:
             i = 0
-            while len(futures) > 0:
-                future = futures[0]
-                futures = futures[1:]
-                result = future.result()
+            for result, decode_time in run_tasks(pool, tasks, window, ordered):
                 if result is not None:
-                    if write_header:
-                        write_header = False
-                        writer.writerow(result.keys())
-                    writer.writerow(result.values())
-                    print(f"wrote result {i} to output csv")
+                    if timings:
+                        result["t_decode"] = decode_time
+                    sink.write(result)
+                    print(f"wrote result {i} to {output_path}")
                     i += 1
-                if not all_submitted:
-                    try:
-                        next_data = next(data_generator)
-                        futures.append(pool.submit(processor, *next_data))
-                    except StopIteration:
-                        all_submitted = True
+    finally:
+        sink.close()
+
+def generate_data(data_path, output_path, processor, limit = None, timings = False, use_parsed_cache = True, resume = True,
+                  workers = None, window = 64, batch_txs = 2000, ordered = True, worker_decode = False):
+    generate_data_files([(data_path, None)], output_path, processor, limit, timings, use_parsed_cache, resume,
+                        workers, window, batch_txs, ordered, readers=1, worker_decode=worker_decode)
 
 def get_files(folder_path, extension):
     return [os.path.join(folder_path, f) for f in os.listdir(folder_path) if f.endswith(extension)]
 
-def main():
-    dirpath = f"F:\\prev_E\\traces"
-    output_path = "output.csv"
-    if os.path.exists(output_path):
-        os.remove(output_path)
-    for file in get_files(dirpath, ".h5"):
-        generate_data(file, "output.csv", process_prestate_trace)
-    plot_data(output_path)
+def parse_shard(path, blocks):
+    # "path" or "path@start-end", an explicit range overriding --blocks
+    block_range = blocks
+    if "@" in path:
+        path, shard_blocks = path.rsplit("@", 1)
+        start, end = shard_blocks.split("-")
+        block_range = range(int(start), int(end))
+    if os.path.isdir(path):
+        return [(file, block_range) for file in get_files(path, ".h5") if not file.endswith(PARSED_CACHE_SUFFIX)]
+    return [(path, block_range)]
+
+def parse_budget(entry):
+    # "seconds" or "name=seconds", see graph_metrics.get_metric_budget
+    name, _, seconds = entry.rpartition("=")
+    return (name or None), float(seconds)
+
+def get_budgets(entries):
+    # --budget entries -> the budgets of get_graph_metrics, an entry without a name is the budget of the tiers not named
+    if entries is None:
+        return None
+    budgets = dict(entries)
+    default = budgets.pop(None, None)
+    if len(budgets) == 0:
+        return default
+    if default is not None:
+        for tier in METRIC_TIERS:
+            budgets.setdefault(tier, default)
+    return budgets
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Computes conflict graph metrics of downloaded block traces.")
+    parser.add_argument("paths", nargs="+", help="trace directories or .h5 files, a file may be suffixed with @start-end")
+    parser.add_argument("--output", default="output.csv", help="a .csv file, or a .parquet directory of row groups")
+    parser.add_argument("--blocks", help="only process blocks in start-end")
+    parser.add_argument("--tracer", choices=["prestate", "call"], default="prestate")
+    parser.add_argument("--backend", choices=list(GRAPH_BACKENDS), default="networkx")
+    parser.add_argument("--storage-slots", action="store_true", help="prestate conflicts on storage slots and account fields instead of accounts")
+    parser.add_argument("--metrics", nargs="+", help="metric or tier names, defaults to DEFAULT_METRICS")
+    parser.add_argument("--budget", nargs="+", type=parse_budget,
+                        help="seconds per metric, or metric / tier name=seconds entries, over budget a metric is NaN")
+    parser.add_argument("--clique-node-limit", type=int, help="search nodes the max clique search may expand, unlimited by default")
+    parser.add_argument("--clique-time-limit", type=float, help="seconds the max clique search may run per block, unlimited by default")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, defaults to the cpu count")
+    parser.add_argument("--readers", type=int, default=2, help="trace files decoded concurrently")
+    parser.add_argument("--batch-txs", type=int, default=2000, help="txs per pool task")
+    parser.add_argument("--window", type=int, default=64, help="pool tasks in flight")
+    parser.add_argument("--unordered", action="store_true", help="write rows as tasks complete")
+    parser.add_argument("--worker-decode", action="store_true", help="workers read and decode the trace chunks themselves")
+    parser.add_argument("--restart", action="store_true", help="discard the existing output instead of resuming it")
+    parser.add_argument("--repair", action="store_true", help="fetch the missing and incomplete blocks of the trace files instead")
+    parser.add_argument("--timings", action="store_true")
+    parser.add_argument("--no-plot", action="store_true")
+    return parser.parse_args(argv)
+
+def repair(shards, fetcher, window=64):
+    data_paths = list(dict.fromkeys(data_path for data_path, _ in shards))
+    remaining = repair_files(data_paths, fetcher, window=window)
+    for data_path in remaining:
+        # the parsed cache of a repaired file misses its new blocks
+        if os.path.exists(get_parsed_cache_path(data_path)):
+            os.remove(get_parsed_cache_path(data_path))
+
+def main(argv=None):
+    args = parse_args(argv)
+    blocks = None
+    if args.blocks is not None:
+        start, end = args.blocks.split("-")
+        blocks = range(int(start), int(end))
+    shards = [shard for path in args.paths for shard in parse_shard(path, blocks)]
+    if args.repair:
+        repair(shards, fetcher_prestate if args.tracer == "prestate" else fetcher_call, args.window)
+        return
+    if args.restart and os.path.isdir(args.output):
+        shutil.rmtree(args.output)
+    elif args.restart and os.path.exists(args.output):
+        os.remove(args.output)
+    processor = process_prestate_trace if args.tracer == "prestate" else process_call_trace
+    options = {
+        "graph_backend": args.backend, "metrics": args.metrics,
+        "clique_node_limit": args.clique_node_limit, "clique_time_limit": args.clique_time_limit,
+    }
+    if args.budget is not None:
+        options["budgets"] = get_budgets(args.budget)
+    if args.storage_slots:
+        options["storage_slots"] = True
+    processor = partial(processor, **options)
+    generate_data_files(
+        shards, args.output, processor, timings=args.timings, resume=not args.restart,
+        workers=args.workers, window=args.window, batch_txs=args.batch_txs, ordered=not args.unordered, readers=args.readers,
+        worker_decode=args.worker_decode,
+    )
+    if not args.no_plot:
+        plot_data(args.output)
 
-def download_files():
+def download_files(streaming=True, level=7):
+    # streaming keeps each trace as compressed json text from the response to the file, see AsyncTraceFetcher.post_compressed
     dirpath = f"F:\\prev_E\\missing"
     filesize = 1000
     for begin in range(21100000, 21200000, filesize):
         end = begin + filesize
         filename = f"{begin}_{end}_preState_compressed.h5"
-        traces_generator = fetch_parallel(range(begin, end), fetcher_prestate)
-        save_to_file(os.path.join(dirpath, filename), traces_generator)
+        if streaming:
+            traces_generator = fetch_parallel(range(begin, end), fetcher_prestate, compression_level=level)
+            save_compressed_to_file(os.path.join(dirpath, filename), traces_generator, level=level, block_range=range(begin, end))
+        else:
+            traces_generator = fetch_parallel(range(begin, end), fetcher_prestate)
+            save_to_file(os.path.join(dirpath, filename), traces_generator, block_range=range(begin, end))
 
 if __name__ == "__main__":
     main()
@@ -1,4 +1,5 @@
-from typing import Dict, List, Set, Tuple
+import hashlib
+from typing import Dict, Hashable, List, Optional, Set, Tuple
 import networkx as nx
 import numpy as np
 
@@ -34,9 +35,73 @@ def apply_recursively(obj, f):
     else:
         return f(obj)
 
+class KeyInterner:
+    """Maps addresses / storage keys to dense integer ids, scoped to a block or a file."""
+
+    def __init__(self):
+        self.ids: Dict[Hashable, int] = {}
+        self.keys: List[Hashable] = []
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def intern(self, key: Hashable) -> int:
+        key_id = self.ids.get(key)
+        if key_id is None:
+            key_id = len(self.keys)
+            self.ids[key] = key_id
+            self.keys.append(key)
+        return key_id
+
+    def intern_set(self, keys) -> Set[int]:
+        return {self.intern(key) for key in keys}
+
+    def lookup(self, key_id: int) -> Hashable:
+        return self.keys[key_id]
+
+    def lookup_set(self, key_ids) -> Set[Hashable]:
+        return {self.keys[key_id] for key_id in key_ids}
+
+def intern_read_write_sets(reads: Dict[str, Set[str]], writes: Dict[str, Set[str]], interner: Optional[KeyInterner] = None) -> Tuple[Dict[str, Set[int]], Dict[str, Set[int]], KeyInterner]:
+    if interner is None:
+        interner = KeyInterner()
+    interned_reads = {tx_hash: interner.intern_set(tx_reads) for tx_hash, tx_reads in reads.items()}
+    interned_writes = {tx_hash: interner.intern_set(tx_writes) for tx_hash, tx_writes in writes.items()}
+    return interned_reads, interned_writes, interner
+
 def create_conflict_graph(txs: List[str], reads: Dict[str, Set[str]], writes: Dict[str, Set[str]]) -> nx.Graph:
     G = nx.Graph()
 
+    # in block order, which orients each conflict from the earlier tx to the later one (see graph_metrics.critical_path_length)
+    G.add_nodes_from(txs)
+
+    # index every key by the txs that read / write it, so only txs sharing a key are ever compared
+    key_readers: Dict[str, List[str]] = {}
+    key_writers: Dict[str, List[str]] = {}
+    for tx_hash, tx_writes in writes.items():
+        for key in tx_writes:
+            key_writers.setdefault(key, []).append(tx_hash)
+    for tx_hash, tx_reads in reads.items():
+        for key in tx_reads:
+            key_readers.setdefault(key, []).append(tx_hash)
+
+    edges = set()
+    for key, writers in key_writers.items():
+        readers = key_readers.get(key, [])
+        for i, tx0_hash in enumerate(writers):
+            for tx1_hash in writers[i + 1:]:
+                edges.add((tx0_hash, tx1_hash))
+            for tx1_hash in readers:
+                if tx0_hash != tx1_hash:
+                    edges.add((tx0_hash, tx1_hash))
+    G.add_edges_from(edges)
+
+    return G
+
+def create_conflict_graph_pairwise(txs: List[str], reads: Dict[str, Set[str]], writes: Dict[str, Set[str]]) -> nx.Graph:
+    # reference O(txs^2) implementation, kept to cross-check create_conflict_graph
+    G = nx.Graph()
+
     G.add_nodes_from(txs)
     
     for tx0_hash, tx0_writes in writes.items():
@@ -44,7 +109,7 @@ def create_conflict_graph(txs: List[str], reads: Dict[str, Set[str]], writes: Di
         if tx0_hash != tx1_hash:
           if not tx0_writes.isdisjoint(tx1_reads):
             G.add_edge(tx0_hash, tx1_hash)
-      for tx1_hash, tx1_writes in reads.items():
+      for tx1_hash, tx1_writes in writes.items():
         # checks both tx0_hash != tx1_hash and removes redundent checks with >
         if tx0_hash > tx1_hash:
           if not tx0_writes.isdisjoint(tx1_writes):
@@ -52,7 +117,59 @@ def create_conflict_graph(txs: List[str], reads: Dict[str, Set[str]], writes: Di
 
     return G
 
-def parse_preStateTracer_trace(block_trace_diffFalse: dict, block_trace_diffTrue: dict) -> Tuple[Dict[str, Set[str]],Dict[str, Set[str]]]:
+# account fields that are keys of their own, next to the account's storage slots, with storage_slots
+ACCOUNT_FIELDS = ["balance", "nonce", "code"]
+
+def storage_key(address: str, slot: str) -> int:
+    # 64-bit key of an account's storage slot or field, so the much larger key space stays cheap to index
+    digest = hashlib.blake2b(f"{address.lower()}:{slot.lower()}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little", signed=True)
+
+def account_state_keys(address: str, state: dict) -> Set[int]:
+    keys = {storage_key(address, field) for field in ACCOUNT_FIELDS if field in state}
+    keys.update(storage_key(address, slot) for slot in state.get("storage", {}))
+    return keys
+
+def parse_preStateTracer_trace_slots(block_trace_diffFalse: dict, block_trace_diffTrue: dict) -> Tuple[Dict[str, Set[int]],Dict[str, Set[int]]]:
+    # like parse_preStateTracer_trace, with storage_key keys of the (address, slot / field) pairs each tx touched
+    writes: Dict[str, Set[int]] = {}
+    reads: Dict[str, Set[int]] = {}
+
+    for entry in block_trace_diffTrue:
+        tx = entry["result"]
+        tx_hash = entry["txHash"]
+        # post has the changed fields and the non-zero changed slots, pre also has the slots that were cleared
+        tx_writes = set()
+        for address, state in tx['post'].items():
+            tx_writes.update(account_state_keys(address, state))
+        for address, state in tx['pre'].items():
+            tx_writes.update(storage_key(address, slot) for slot in state.get("storage", {}))
+            if address not in tx['post']:
+                # destructed account, pre still holds the storage it accessed
+                tx_writes.update(storage_key(address, field) for field in ACCOUNT_FIELDS)
+        if len(tx_writes) > 0:
+          writes[tx_hash] = tx_writes
+
+    for entry in block_trace_diffFalse:
+        tx = entry["result"]
+        tx_hash = entry["txHash"]
+        tx_reads = set()
+        for address, state in tx.items():
+            tx_reads.update(account_state_keys(address, state))
+        tx_reads.difference_update(writes.get(tx_hash, set()))
+        if len(tx_reads) > 0:
+          reads[tx_hash] = tx_reads
+
+    return reads, writes
+
+def parse_preStateTracer_trace(block_trace_diffFalse: dict, block_trace_diffTrue: dict, interner: Optional[KeyInterner] = None, storage_slots: bool = False) -> Tuple[Dict[str, Set[str]],Dict[str, Set[str]]]:
+    # keys are the accounts each tx touched, or with storage_slots their storage slots and fields
+    if storage_slots:
+        reads, writes = parse_preStateTracer_trace_slots(block_trace_diffFalse, block_trace_diffTrue)
+        if interner is not None:
+            reads, writes, _ = intern_read_write_sets(reads, writes, interner)
+        return reads, writes
+
     writes: Dict[str, Set[str]] = {}
     reads: Dict[str, Set[str]] = {}
     
@@ -69,99 +186,141 @@ def parse_preStateTracer_trace(block_trace_diffFalse: dict, block_trace_diffTrue
         tx_hash = entry["txHash"]
         tx_reads = set(tx).difference(writes.get(tx_hash, set()))
         if len(tx_reads) > 0:
-          reads[tx_hash] = set(tx).difference(writes.get(tx_hash, set()))
+          reads[tx_hash] = tx_reads
     
+    if interner is not None:
+        reads, writes, _ = intern_read_write_sets(reads, writes, interner)
     return reads, writes
 
-def create_call_graph_recursive(G: nx.Graph, call) -> None:
-    node_id = G.number_of_nodes()
-    G.add_node(node_id)
-    if 'calls' in call:
-        for call in call['calls']:
-            child_id = create_call_graph_recursive(G, call)
-            G.add_edge(node_id, child_id)
-    return node_id
-
-def create_call_graphs(trace) -> List[nx.Graph]:
-    graphs = []
-    for tx in trace:
-        G = nx.Graph()
-        create_call_graph_recursive(G, tx['result'])
-        graphs.append(G)
-    return graphs 
+CALL_METRIC_COLUMNS = [
+    "mean_call_count_smart_contract",
+    "mean_call_height_smart_contract",
+    "mean_call_degree_smart_contract",
+    "mean_call_count_leaves_smart_contract",
+    "count_txs_value_transfer",
+]
 
-def get_callTracer_additional_metrics(trace) -> Dict[str, float]:
-    call_graphs = create_call_graphs(trace)
-    call_graphs_smart_contracts = [G for G in call_graphs if G.number_of_nodes() > 1]
-    call_counts = [G.number_of_nodes() for G in call_graphs_smart_contracts]
-    call_heights = [1 + max(nx.shortest_path_length(G, source=0).values()) for G in call_graphs_smart_contracts]
-    call_degrees = [np.mean([val for (_, val) in G.degree()]) for G in call_graphs_smart_contracts]
-    call_leaves = [np.sum([1 for (node, val) in G.degree() if node != 0]) for G in call_graphs_smart_contracts]
-    count_txs_value_transfer = len(call_graphs) - len(call_graphs_smart_contracts)
-    return {
-        "mean_call_count_smart_contract": np.mean(call_counts),
-        "mean_call_height_smart_contract": np.mean(call_heights),
-        "mean_call_degree_smart_contract": np.mean(call_degrees),
-        "mean_call_count_leaves_smart_contract": np.mean(call_leaves),
-        "count_txs_value_transfer": count_txs_value_transfer
-    }
-    
-def parse_callTracer_trace_calls(call, reads, writes, inherited_prems = [True, True, True, True]):
-    # CALLTYPE, RF, WF, RT, WT
-    calls_prems = {
-        "CALL":[True,False,True,True],
-        "DELEGATECALL":[True,True,True,False],
-        "CALLCODE":[True,True,True,False],
-        "CREATE":[True,True,False,True],
-        "CREATE2":[True,True,False,True],
-        "STATICCALL":[True,False,True,False],
-        "SELFDESTRUCT":[True,False,False,True],
-        "SUICIDE":[True,False,False,True],
-        "INVALID":[False,False,False,False],
-        "REVERT":[False,False,False,False],
-    }
-    
-    call_type = call["type"]
-    prems = [p0 and p1 for (p0, p1) in zip(calls_prems[call_type], inherited_prems)]
-    from_addr = call["from"]
-    to_addr = call["to"]
-    
-    if prems[0]:
-        reads.add(from_addr)
-    if prems[1]:
-        writes.add(from_addr)
-    if prems[2]:
-        reads.add(to_addr)
-    if prems[3]:
-        writes.add(to_addr)
+# call type -> whether it reads from, writes from, reads to, writes to
+CALL_PERMISSIONS = {
+    "CALL":[True,False,True,True],
+    "DELEGATECALL":[True,True,True,False],
+    "CALLCODE":[True,True,True,False],
+    "CREATE":[True,True,False,True],
+    "CREATE2":[True,True,False,True],
+    "STATICCALL":[True,False,True,False],
+    "SELFDESTRUCT":[True,False,False,True],
+    "SUICIDE":[True,False,False,True],
+    "INVALID":[False,False,False,False],
+    "REVERT":[False,False,False,False],
+}
 
-    if "calls" in call:
-        for sub_call in call["calls"]:
-            parse_callTracer_trace_calls(sub_call, reads, writes)
+def walk_call_tree(tx) -> Tuple[int, int, int, Set[str], Set[str]]:
+    """
+    One iterative pass over the call frames of a tx's callTracer result.
+    Returns (call count, height, leaf count, reads, writes); the tx's own frame counts as a call
+    but, like the sub-calls' permissions, its from / to only go to reads / writes through its sub-calls.
+    """
+    reads = set()
+    writes = set()
+    call_count = 0
+    height = 0
+    leaves = 0
+    stack = [(tx, 1)]
+    while len(stack) > 0:
+        call, depth = stack.pop()
+        call_count += 1
+        height = max(height, depth)
+        sub_calls = call.get("calls", [])
+        if len(sub_calls) == 0:
+            leaves += 1
+        if depth > 1:
+            can_read_from, can_write_from, can_read_to, can_write_to = CALL_PERMISSIONS[call["type"]]
+            if can_read_from:
+                reads.add(call["from"])
+            if can_write_from:
+                writes.add(call["from"])
+            if can_read_to:
+                reads.add(call["to"])
+            if can_write_to:
+                writes.add(call["to"])
+        stack.extend((sub_call, depth + 1) for sub_call in sub_calls)
+    return call_count, height, leaves, reads, writes
 
+def mean(values) -> float:
+    return float(np.mean(values)) if len(values) > 0 else float('nan')
 
-def parse_callTracer_trace(block_trace):
-    writes: Dict[str, Set[str]] = {}
+def parse_callTracer_block(block_trace, interner: Optional[KeyInterner] = None) -> Tuple[Dict[str, float], Dict[str, Set[str]], Dict[str, Set[str]]]:
+    # CALL_METRIC_COLUMNS and the read / write sets of a block, with one walk_call_tree per tx
     reads: Dict[str, Set[str]] = {}
-
+    writes: Dict[str, Set[str]] = {}
+    call_counts = []
+    call_heights = []
+    call_degrees = []
+    call_leaves = []
     for entry in block_trace:
-        tx = entry["result"]
         tx_hash = entry["txHash"]
-        if "calls" in tx:
-            for call in tx["calls"]:
-                iter_reads = set()
-                iter_writes = set()
-                parse_callTracer_trace_calls(call, iter_reads, iter_writes)
-                if tx_hash not in writes:
-                    writes[tx_hash] = iter_writes
-                else:
-                    writes[tx_hash].update(iter_writes)
-                if tx_hash not in reads:
-                    reads[tx_hash] = iter_reads
-                else:
-                    reads[tx_hash].update(iter_reads)
+        call_count, height, leaves, tx_reads, tx_writes = walk_call_tree(entry["result"])
+        if call_count > 1:
+            call_counts.append(call_count)
+            call_heights.append(height)
+            # a tree of n calls has n - 1 edges
+            call_degrees.append(2 * (call_count - 1) / call_count)
+            call_leaves.append(leaves)
+            reads.setdefault(tx_hash, set()).update(tx_reads)
+            writes.setdefault(tx_hash, set()).update(tx_writes)
+    additional_metrics = {
+        "mean_call_count_smart_contract": mean(call_counts),
+        "mean_call_height_smart_contract": mean(call_heights),
+        "mean_call_degree_smart_contract": mean(call_degrees),
+        "mean_call_count_leaves_smart_contract": mean(call_leaves),
+        "count_txs_value_transfer": len(block_trace) - len(call_counts),
+    }
+    if interner is not None:
+        reads, writes, _ = intern_read_write_sets(reads, writes, interner)
+    return additional_metrics, reads, writes
+
+def get_callTracer_additional_metrics(trace) -> Dict[str, float]:
+    additional_metrics, _, _ = parse_callTracer_block(trace)
+    return additional_metrics
+
+def parse_callTracer_trace(block_trace, interner: Optional[KeyInterner] = None):
+    _, reads, writes = parse_callTracer_block(block_trace, interner)
     return reads, writes
 
+def to_parsed_block(block_number: int, txs: List[str], reads: Dict[str, Set[int]], writes: Dict[str, Set[int]], interner: KeyInterner, additional_metrics: Dict[str, float] = {}) -> list:
+    # compact, JSON-able form of a parsed block: key table + per-tx sorted key ids, aligned with txs
+    return [
+        block_number,
+        txs,
+        interner.keys,
+        [sorted(reads.get(tx_hash, ())) for tx_hash in txs],
+        [sorted(writes.get(tx_hash, ())) for tx_hash in txs],
+        additional_metrics,
+    ]
+
+def from_parsed_block(txs: List[str], reads: List[List[int]], writes: List[List[int]]) -> Tuple[Dict[str, Set[int]], Dict[str, Set[int]]]:
+    # inverse of to_parsed_block, txs without reads / writes are left out like the trace parsers do
+    return (
+        {tx_hash: set(tx_reads) for tx_hash, tx_reads in zip(txs, reads) if len(tx_reads) > 0},
+        {tx_hash: set(tx_writes) for tx_hash, tx_writes in zip(txs, writes) if len(tx_writes) > 0},
+    )
+
+def parse_prestate_block(block_number: int, diffFalse, diffTrue):
+    if diffFalse is None or diffTrue is None:
+        return None
+    interner = KeyInterner()
+    reads, writes = parse_preStateTracer_trace(diffFalse, diffTrue, interner)
+    txs = [tx_trace["txHash"] for tx_trace in diffFalse]
+    return to_parsed_block(block_number, txs, reads, writes, interner)
+
+def parse_call_block(block_number: int, call_trace):
+    if call_trace is None:
+        return None
+    interner = KeyInterner()
+    additional_metrics, reads, writes = parse_callTracer_block(call_trace, interner)
+    txs = [tx_trace["txHash"] for tx_trace in call_trace]
+    return to_parsed_block(block_number, txs, reads, writes, interner, additional_metrics)
+
 def has_field(tx, field):
     return field in tx and tx[field] != b'' and tx[field] != None
 
@@ -5,6 +5,8 @@ import numpy as np
 import pandas as pd
 import networkx as nx
 
+from sinks import load_output, read_output_columns
+
 def plot_graph(graph):
     plt.figure(figsize=(8, 6))
     pos = nx.kamada_kawai_layout(graph)  # positions for all nodes
@@ -119,14 +121,34 @@ def plot_call_metrics(_df):
     plt.savefig(f"figures\\call_metrics.png")
     plt.close()
 
-def plot_data(csv_path):
+def print_timing_report(output_path, lines_count = 4, top = 5):
+    # summarizes the t_<stage> columns written by generate_data(..., timings=True)
+    time_columns = [column for column in read_output_columns(output_path) if column.startswith("t_")]
+    if len(time_columns) == 0:
+        raise ValueError("The output has no t_<stage> timing columns.")
+    df = load_output(output_path, ["block_number", "txs"] + time_columns)
+    df = df.drop_duplicates(subset='block_number', keep='first')
+
+    df['txs_bin'] = pd.qcut(df['txs'], q=lines_count, duplicates='drop')
+    mean_times = df.groupby('txs_bin', observed=True)[time_columns].mean()
+    for txs_bin, row in mean_times.iterrows():
+        print(f"#txs in {txs_bin}: total {row.sum():.4f}s per block")
+        for column, seconds in row.sort_values(ascending=False).head(top).items():
+            print(f"    {column[2:]}: {seconds:.4f}s ({100 * seconds / row.sum():.1f}%)")
+
+def plot_data(output_path):
     markers = ["o", "s", "^", "v", "D", "*"]
     
     lines_count = 4
     bins_count = 16
     quant_fill = 0.05
 
-    df = pd.read_csv(csv_path)
+    # the timed_out names and the t_<stage> / m_<stage> timings aren't properties to plot
+    columns = [
+        column for column in read_output_columns(output_path)
+        if column != "timed_out" and not column.startswith(("t_", "m_"))
+    ]
+    df = load_output(output_path, columns)
     df = df.drop_duplicates(subset='block_number', keep='first')
     
     print(max(df['block_number']),  min(df['block_number']), max(df['block_number'])-min(df['block_number']), len(df['block_number']))
@@ -136,16 +158,20 @@ def plot_data(csv_path):
     #plot_call_metrics(df)
     plot_block_size_distribution(df)
     #plot_smart_contract_percent(df)
-    df['min_path_chromatic_ratio'] = df['longest_path_length_monte_carlo'] / df['greedy_color']
-    df['max_path_chromatic_ratio'] = df['largest_conn_comp'] / df['clique_number']
-    
-    print("XXXX")
-    print(np.median(df['min_path_chromatic_ratio']), np.median(df['max_path_chromatic_ratio']))
-    print(np.mean(df['min_path_chromatic_ratio']), np.mean(df['max_path_chromatic_ratio']))
-    
-    # Ensure the data has X, Y, and other columns
-    if "density" not in df.columns or "txs" not in df.columns:
-        raise ValueError("The CSV file must contain 'X' and 'Y' columns.")
+    # a --metrics selection may leave out either side of a ratio
+    ratios = {
+        'min_path_chromatic_ratio': ('longest_path_length_monte_carlo', 'greedy_color'),
+        'max_path_chromatic_ratio': ('largest_conn_comp', 'clique_number'),
+    }
+    for ratio, (numerator, denominator) in ratios.items():
+        if numerator in df.columns and denominator in df.columns:
+            df[ratio] = df[numerator] / df[denominator]
+            print(f"{ratio}: median {np.median(df[ratio])}, mean {np.mean(df[ratio])}")
+    
+    # the properties are plotted against density
+    if "density" not in df.columns:
+        print("The output has no density column, skipping the per-property plots.")
+        return
 
     # Extract X, Y, and property columns
     properties = df.drop(columns=["density"]).columns
@@ -1,55 +1,181 @@
-from itertools import count
-import json
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
 import math
 import os
 import pickle
+import queue
+import re
+import threading
+import time
 import h5py
-import zlib
 import numpy as np
+from typing import Dict, List, Optional
 
+from chunk_codecs import ChunkCodec, join_gzip_members
 from fetchers import fetcher_prestate, fetch_parallel
+from loaders import uncompress_chunk
 from parsers import apply_recursively, hex_to_bytes
 
+# per-block status in a file's ledger, the 'blocks_status' dataset over the file's block range
+BLOCK_MISSING = 0
+BLOCK_SAVED = 1
+BLOCK_INCOMPLETE = 2  # saved, but with a trace that is None
+
 def save_prestate(filename: str, range_start: int, range_stop: int):
   generator = fetch_parallel(range_start, range_stop, fetcher_prestate)
   save_to_file(filename, generator, range_stop-range_start)
     
-def append_to_file(filename: str, generator, limit=None) -> None:
-  if not os.path.exists(filename):
-    raise Exception(f"{filename} doesn't exists!")
-  chunk_size = 100
-  is_done = False
-  for i in count(0, chunk_size):
-      i_chunk = i // chunk_size
-      start = i
-      end = start
-      chunk = []
-      for _ in range(chunk_size):
-        try:
-          chunk.append(next(generator))
-          end += 1
-          if end == limit:
-            is_done = True
-            break
-        except StopIteration:
-          is_done = True
-          break
-      if end - start == 0:
+class ChunkWriter:
+  """
+  Appends chunks of chunk_size entries to an existing file, kept open until close.
+  Chunks are encoded on a pool of compressors while a single writer thread appends them in submission order.
+  The dataset grows geometrically and is trimmed to the written chunks on close; a file left untrimmed
+  by a crash only ends with empty chunks, which loaders skip and the next ChunkWriter drops.
+  The file is flushed every flush_interval seconds or flush_bytes written bytes, whichever comes first.
+  With precompressed, entries are (block_number, gzip member of the json entry, whether no trace is None)
+  and are joined as is.
+  The status of each written block is recorded in the file's ledger, if it has one.
+  """
+
+  def __init__(self, filename: str, chunk_size: int = 100, compressors: int = 4, processes: bool = False,
+               max_pending: int = 16, flush_interval: float = 10.0, flush_bytes: int = 64 << 20, precompressed: bool = False):
+    if not os.path.exists(filename):
+      raise Exception(f"{filename} doesn't exists!")
+    self.filename = filename
+    self.f = h5py.File(filename, 'a')
+    self.codec = ChunkCodec.from_file(self.f)
+    if precompressed and (self.codec.compression != "gzip" or self.codec.serializer != "json"):
+      self.f.close()
+      raise Exception(f"{filename} is {self.codec}, compressed entries need json/gzip")
+    self.dset = self.f['dataset']
+    self.chunks_count = self.dset.shape[0]
+    while self.chunks_count > 0 and len(self.dset[self.chunks_count - 1]) == 0:
+      self.chunks_count -= 1
+    if self.chunks_count == 0 and 'index' not in self.f:
+      create_index_dataset(self.f)
+    self.index = self.f['index'] if 'index' in self.f else None
+    self.ledger = self.f['blocks_status'] if 'blocks_status' in self.f else None
+    self.range_start = int(self.f.attrs['range_start']) if self.ledger is not None else None
+    self.chunk_size = chunk_size
+    self.precompressed = precompressed
+    self.flush_interval = flush_interval
+    self.flush_bytes = flush_bytes
+    self.entries = []
+    self.pool = (ProcessPoolExecutor if processes else ThreadPoolExecutor)(compressors)
+    # futures in submission order, bounded so a slow disk holds back the producer instead of filling memory
+    self.pending = queue.Queue(max_pending)
+    self.errors = []
+    self.saved = 0
+    self.raw_bytes = 0
+    self.written_bytes = 0
+    self.unflushed_bytes = 0
+    self.start_time = time.perf_counter()
+    self.last_flush = self.start_time
+    self.writer = threading.Thread(target=self.write_chunks, daemon=True)
+    self.writer.start()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def write(self, entry) -> None:
+    self.entries.append(entry)
+    if len(self.entries) == self.chunk_size:
+      self.submit()
+
+  def submit(self) -> None:
+    if len(self.errors) > 0:
+      raise self.errors[0]
+    if len(self.entries) == 0:
+      return
+    if self.precompressed:
+      future = self.pool.submit(join_chunk, [member for _, member, _ in self.entries], self.codec.level)
+      statuses = [BLOCK_SAVED if complete else BLOCK_INCOMPLETE for _, _, complete in self.entries]
+    else:
+      future = self.pool.submit(encode_chunk, self.codec, self.entries)
+      statuses = [entry_status(entry) for entry in self.entries]
+    block_numbers = [entry[0] for entry in self.entries]
+    self.pending.put((future, block_numbers, statuses))
+    self.entries = []
+
+  def write_chunks(self) -> None:
+    while True:
+      item = self.pending.get()
+      if item is None:
         return
-      chunk = json.dumps(chunk)
-      chunk = chunk.encode('ascii')
-      chunk = zlib.compress(chunk, 7)
-      chunk = np.frombuffer(chunk, dtype=np.uint8)
-      with h5py.File(filename, 'a') as f:
-        dset = f['dataset']
-        dset.resize((i_chunk + 1,))
-        dset[i_chunk] = chunk
-      print(f"Saved {end} values in total to {filename}")
-      if is_done:
-        break
+      future, block_numbers, statuses = item
+      if len(self.errors) > 0:
+        # keep draining, so submit never blocks on a dead writer, but write nothing after a failed chunk
+        continue
+      try:
+        chunk, raw_size = future.result()
+        self.append_chunk(chunk, block_numbers, statuses, raw_size)
+      except Exception as e:
+        self.errors.append(e)
+
+  def append_chunk(self, chunk: np.ndarray, block_numbers, statuses, raw_size: int) -> None:
+    if self.chunks_count == self.dset.shape[0]:
+      self.dset.resize((max(16, 2 * self.dset.shape[0]),))
+    self.dset[self.chunks_count] = chunk
+    if self.index is not None:
+      append_index_rows(self.index, block_numbers, self.chunks_count)
+    if self.ledger is not None:
+      update_ledger(self.ledger, self.range_start, block_numbers, statuses)
+    self.chunks_count += 1
+    self.saved += len(block_numbers)
+    self.raw_bytes += raw_size
+    self.written_bytes += len(chunk)
+    self.unflushed_bytes += len(chunk)
+    now = time.perf_counter()
+    if now - self.last_flush >= self.flush_interval or self.unflushed_bytes >= self.flush_bytes:
+      self.flush(now)
+
+  def flush(self, now: float) -> None:
+    self.f.flush()
+    self.last_flush = now
+    self.unflushed_bytes = 0
+    print(f"Saved {self.saved} values in total to {self.filename}, {self.throughput()}")
+
+  def throughput(self) -> str:
+    elapsed = max(time.perf_counter() - self.start_time, 1e-9)
+    return f"{self.written_bytes / elapsed / 1e6:.1f} MB/s written ({self.raw_bytes / elapsed / 1e6:.1f} MB/s before compression)"
+
+  def close(self) -> None:
+    try:
+      self.submit()
+    finally:
+      self.pending.put(None)
+      self.writer.join()
+      self.pool.shutdown()
+      self.dset.resize((self.chunks_count,))
+      self.flush(time.perf_counter())
+      self.f.close()
+    if len(self.errors) > 0:
+      raise self.errors[0]
+
+def encode_chunk(codec: ChunkCodec, entries: list):
+  data = codec.serialize(entries)
+  return np.frombuffer(codec.compress(data), dtype=np.uint8), len(data)
+
+def join_chunk(members: list, level: int):
+  chunk = join_gzip_members(members, level)
+  return np.frombuffer(chunk, dtype=np.uint8), len(chunk)
+
+def append_to_file(filename: str, generator, limit=None, **writer_options) -> None:
+  with ChunkWriter(filename, **writer_options) as writer:
+    for entry in islice(generator, limit):
+      writer.write(entry)
   
   
-def save_to_file(filename: str, generator, limit=None) -> None:
+def save_to_file(filename: str, generator, limit=None, codec: Optional[ChunkCodec] = None, block_range: Optional[range] = None,
+                 **writer_options) -> None:
+  # with block_range, the file gets a ledger of which of its blocks are saved, see repair_files
+  create_file(filename, codec, block_range)
+  append_to_file(filename, generator, limit, **writer_options)
+
+def create_file(filename: str, codec: Optional[ChunkCodec] = None, block_range: Optional[range] = None) -> None:
   if os.path.exists(filename):
     raise Exception(f"{filename} already exists!")
   with h5py.File(filename, 'w') as f:
@@ -59,4 +185,140 @@ def save_to_file(filename: str, generator, limit=None) -> None:
           shape=(0,),
           dtype=h5py.vlen_dtype(np.dtype('uint8')),
       )
-  append_to_file(filename, generator, limit)
\ No newline at end of file
+      create_index_dataset(f)
+      (codec if codec is not None else ChunkCodec()).write_attrs(f)
+      if block_range is not None:
+        create_ledger(f, block_range)
+
+def append_compressed_to_file(filename: str, generator, limit=None, **writer_options) -> None:
+  # generator yields (block_number, gzip member of the json entry, complete), as fetch_parallel does with a compression_level,
+  # and the members are concatenated into chunks as is, so no trace is ever decoded or re-serialized
+  append_to_file(filename, generator, limit, precompressed=True, **writer_options)
+
+def save_compressed_to_file(filename: str, generator, limit=None, level: int = 7, block_range: Optional[range] = None,
+                            **writer_options) -> None:
+  create_file(filename, ChunkCodec("gzip", level), block_range)
+  append_compressed_to_file(filename, generator, limit, **writer_options)
+
+def create_index_dataset(f: h5py.File):
+  # one (block_number, chunk, offset in chunk) row per saved entry
+  return f.create_dataset(
+      'index',
+      maxshape=(None, 3),
+      shape=(0, 3),
+      dtype=np.int64,
+  )
+
+def append_index_rows(index, block_numbers, i_chunk: int):
+  rows = np.array([(block_number, i_chunk, offset) for offset, block_number in enumerate(block_numbers)], dtype=np.int64)
+  start = index.shape[0]
+  index.resize((start + len(rows), 3))
+  index[start:] = rows
+
+def build_index(filename: str, overwrite=False) -> None:
+  # indexes a file written before save_to_file started writing the index
+  if not os.path.exists(filename):
+    raise Exception(f"{filename} doesn't exists!")
+  with h5py.File(filename, 'a') as f:
+    if 'index' in f:
+      if not overwrite:
+        raise Exception(f"{filename} already has an index!")
+      del f['index']
+    index = create_index_dataset(f)
+    dset = f['dataset']
+    codec = ChunkCodec.from_file(f)
+    for i_chunk in range(dset.shape[0]):
+      entries = uncompress_chunk(dset, i_chunk, codec)
+      append_index_rows(index, [entry[0] for entry in entries], i_chunk)
+      print(f"Indexed chunk {i_chunk + 1}/{dset.shape[0]} of {filename}")
+
+def entry_status(entry) -> int:
+  return BLOCK_SAVED if all(trace is not None for trace in entry[1:]) else BLOCK_INCOMPLETE
+
+def create_ledger(f: h5py.File, block_range: range):
+  f.attrs['range_start'] = block_range.start
+  f.attrs['range_stop'] = block_range.stop
+  return f.create_dataset('blocks_status', data=np.full(len(block_range), BLOCK_MISSING, dtype=np.int8))
+
+def update_ledger(ledger, range_start: int, block_numbers, statuses) -> None:
+  status = ledger[:]
+  for block_number, block_status in zip(block_numbers, statuses):
+    if range_start <= block_number < range_start + len(status):
+      status[block_number - range_start] = block_status
+    else:
+      print(f"block {block_number} is outside the range of {ledger.file.filename}")
+  ledger[:] = status
+
+def parse_block_range(filename: str) -> Optional[range]:
+  # download_files names files {begin}_{end}_<tracer>_compressed.h5
+  match = re.match(r"(\d+)_(\d+)_", os.path.basename(filename))
+  return range(int(match.group(1)), int(match.group(2))) if match is not None else None
+
+def build_ledger(filename: str, block_range: Optional[range] = None, overwrite=False) -> None:
+  # records the status of the blocks of a file written before save_to_file started writing the ledger
+  if block_range is None:
+    block_range = parse_block_range(filename)
+    if block_range is None:
+      raise Exception(f"no block range given, and none in the name of {filename}")
+  with h5py.File(filename, 'a') as f:
+    if 'blocks_status' in f:
+      if not overwrite:
+        raise Exception(f"{filename} already has a ledger!")
+      del f['blocks_status']
+    ledger = create_ledger(f, block_range)
+    dset = f['dataset']
+    codec = ChunkCodec.from_file(f)
+    for i_chunk in range(dset.shape[0]):
+      entries = uncompress_chunk(dset, i_chunk, codec)
+      update_ledger(ledger, block_range.start, [entry[0] for entry in entries], [entry_status(entry) for entry in entries])
+    print(f"Built the ledger of {filename}")
+
+def read_ledger(filename: str):
+  # (block range, status per block), None for files without a ledger
+  with h5py.File(filename, 'r') as f:
+    if 'blocks_status' not in f:
+      return None
+    return range(int(f.attrs['range_start']), int(f.attrs['range_stop'])), f['blocks_status'][:]
+
+def missing_blocks(filename: str, ledger=None) -> Dict[int, int]:
+  # block number -> status, for the blocks of the file's range that are missing or incomplete
+  block_range, status = ledger if ledger is not None else read_ledger(filename)
+  return {block_range.start + int(i): int(status[i]) for i in np.flatnonzero(status != BLOCK_SAVED)}
+
+def repair_files(filenames: List[str], fetcher=fetcher_prestate, **fetch_options) -> Dict[str, Dict[int, int]]:
+  """
+  Fetches the missing and incomplete blocks of all filenames in one concurrent fetch_parallel,
+  and appends each to its file. Files without a ledger get one from the block range in their name.
+  Returns filename -> blocks still missing or incomplete.
+  """
+  file_blocks = {}
+  for filename in filenames:
+    ledger = read_ledger(filename)
+    if ledger is None:
+      if parse_block_range(filename) is None:
+        print(f"skipping {filename}, it has no ledger and no block range in its name")
+        continue
+      build_ledger(filename)
+      ledger = read_ledger(filename)
+    blocks = missing_blocks(filename, ledger)
+    print(f"{filename}: {sum(status == BLOCK_MISSING for status in blocks.values())} blocks missing, "
+          f"{sum(status == BLOCK_INCOMPLETE for status in blocks.values())} incomplete")
+    if len(blocks) > 0:
+      file_blocks[filename] = blocks
+  block_files = {block_number: filename for filename, blocks in file_blocks.items() for block_number in blocks}
+  writers = {}
+  try:
+    for filename in file_blocks:
+      writers[filename] = ChunkWriter(filename)
+    for entry in fetch_parallel(sorted(block_files), fetcher, **fetch_options):
+      filename = block_files[entry[0]]
+      # a block that failed again is only worth an entry if it had none
+      if entry_status(entry) == BLOCK_SAVED or file_blocks[filename][entry[0]] == BLOCK_MISSING:
+        writers[filename].write(entry)
+  finally:
+    for writer in writers.values():
+      writer.close()
+  remaining = {filename: missing_blocks(filename) for filename in file_blocks}
+  for filename, blocks in remaining.items():
+    print(f"{filename}: {len(file_blocks[filename]) - len(blocks)} blocks repaired, {len(blocks)} left")
+  return remaining
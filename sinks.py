@@ -0,0 +1,156 @@
+import csv
+import io
+import os
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+INT_COLUMNS = {"block_number", "txs", "count_txs_value_transfer"}
+STRING_COLUMNS = {"timed_out"}
+
+
+def column_dtype(column: str) -> str:
+    if column in INT_COLUMNS:
+        return "int64"
+    if column in STRING_COLUMNS:
+        return "string"
+    return "float64"
+
+def read_csv_header(path: str) -> Optional[List[str]]:
+    with open(path, mode="r", newline="") as file:
+        return next(csv.reader(file), None)
+
+def parquet_part_files(path: str) -> List[str]:
+    return sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith(".parquet"))
+
+
+class CsvSink:
+    """Appends rows to a csv file, one write + flush per row, columns in schema order."""
+
+    def __init__(self, path: str, columns: Optional[List[str]] = None):
+        self.path = path
+        self.columns = columns
+        if os.path.exists(path):
+            self.truncate_partial_row()
+            header = read_csv_header(path)
+            if header is not None:
+                if columns is not None and header != columns:
+                    print(f"{path} has columns {header}, keeping them over {columns}")
+                self.columns = header
+        self.write_header = self.columns is None or not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, mode="a", newline="")
+
+    def truncate_partial_row(self) -> None:
+        # drops a trailing row left half-written by a crash
+        with open(self.path, mode="rb+") as file:
+            data = file.read()
+            if len(data) > 0 and not data.endswith(b"\n"):
+                file.truncate(data.rfind(b"\n") + 1)
+
+    def completed_blocks(self) -> set:
+        # block numbers are unique across trace files, so the output's block_number column is the checkpoint
+        if self.columns is None or "block_number" not in self.columns:
+            return set()
+        i_block_number = self.columns.index("block_number")
+        with open(self.path, mode="r", newline="") as file:
+            reader = csv.reader(file)
+            next(reader, None)
+            return {int(row[i_block_number]) for row in reader if len(row) > i_block_number}
+
+    def write(self, row: Dict) -> None:
+        if self.columns is None:
+            # no schema given, fall back to the first row's keys
+            self.columns = list(row.keys())
+        line = io.StringIO()
+        writer = csv.DictWriter(line, self.columns, restval="", extrasaction="ignore")
+        if self.write_header:
+            self.write_header = False
+            writer.writeheader()
+        writer.writerow(row)
+        # one write + flush per row, so a crash can only leave a partial last line, which reopening truncates
+        self.file.write(line.getvalue())
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class ParquetSink:
+    """
+    Writes rows as a directory of parquet files, one file (a single row group) per batch_rows rows.
+    Each file is written under a temporary name and renamed when complete, so a crash loses
+    at most the rows still buffered and never leaves a corrupt file behind.
+    """
+
+    def __init__(self, path: str, columns: List[str], batch_rows: int = 10000):
+        if pq is None:
+            raise Exception("parquet output needs the pyarrow package")
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        part_files = parquet_part_files(path)
+        if len(part_files) > 0:
+            self.schema = pq.read_schema(part_files[0])
+            if columns is not None and self.schema.names != columns:
+                print(f"{path} has columns {self.schema.names}, keeping them over {columns}")
+        elif columns is not None:
+            arrow_types = {"int64": pa.int64(), "float64": pa.float64(), "string": pa.string()}
+            self.schema = pa.schema([(column, arrow_types[column_dtype(column)]) for column in columns])
+        else:
+            raise Exception("parquet output needs an explicit schema")
+        self.columns = self.schema.names
+        self.batch_rows = batch_rows
+        self.rows = []
+        self.i_part = len(part_files)
+
+    def completed_blocks(self) -> set:
+        if "block_number" not in self.columns or len(parquet_part_files(self.path)) == 0:
+            return set()
+        return set(pq.read_table(self.path, columns=["block_number"]).column("block_number").to_pylist())
+
+    def write(self, row: Dict) -> None:
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_rows:
+            self.flush()
+
+    def flush(self) -> None:
+        if len(self.rows) == 0:
+            return
+        table = pa.table(
+            {column: [row.get(column) for row in self.rows] for column in self.columns},
+            schema=self.schema,
+        )
+        part_name = f"part-{self.i_part:06d}.parquet"
+        # dot-prefixed, so readers of the directory skip it until it is complete
+        temp_path = os.path.join(self.path, f".{part_name}.tmp")
+        pq.write_table(table, temp_path)
+        os.replace(temp_path, os.path.join(self.path, part_name))
+        self.i_part += 1
+        self.rows = []
+
+    def close(self) -> None:
+        self.flush()
+
+
+def open_sink(path: str, columns: Optional[List[str]] = None):
+    # a path ending with .parquet is a parquet directory, anything else a csv file
+    if path.endswith(".parquet"):
+        return ParquetSink(path, columns)
+    return CsvSink(path, columns)
+
+def read_output_columns(path: str) -> List[str]:
+    if path.endswith(".parquet"):
+        return pq.read_schema(parquet_part_files(path)[0]).names
+    return read_csv_header(path)
+
+def load_output(path: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    # reads only the given columns of the output, all of them by default
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path, columns=columns)
+    return pd.read_csv(path, usecols=columns)
@@ -0,0 +1,134 @@
+from typing import Dict, List, Set
+import networkx as nx
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+
+from parsers import KeyInterner
+
+
+class SparseConflictGraph:
+    """Conflict graph stored as a symmetric boolean CSR adjacency matrix over the block's txs."""
+
+    def __init__(self, txs: List[str], adjacency: sparse.csr_matrix):
+        self.txs = txs
+        self.adjacency = adjacency
+
+    def number_of_nodes(self) -> int:
+        return len(self.txs)
+
+    def number_of_edges(self) -> int:
+        return self.adjacency.nnz // 2
+
+    def degrees(self) -> np.ndarray:
+        return np.diff(self.adjacency.indptr)
+
+    def to_networkx(self) -> nx.Graph:
+        G = nx.Graph()
+        G.add_nodes_from(self.txs)
+        rows, cols = sparse.triu(self.adjacency, k=1).nonzero()
+        G.add_edges_from((self.txs[i], self.txs[j]) for i, j in zip(rows, cols))
+        return G
+
+
+def create_incidence_matrix(tx_ids: Dict[str, int], key_sets: Dict[str, Set[str]], interner: KeyInterner) -> sparse.csr_matrix:
+    rows = []
+    cols = []
+    for tx_hash, keys in key_sets.items():
+        tx_id = tx_ids[tx_hash]
+        for key in keys:
+            rows.append(tx_id)
+            cols.append(interner.intern(key))
+    data = np.ones(len(rows), dtype=np.int32)
+    return sparse.csr_matrix((data, (rows, cols)), shape=(len(tx_ids), len(interner)))
+
+def create_sparse_conflict_graph(txs: List[str], reads: Dict[str, Set[str]], writes: Dict[str, Set[str]]) -> SparseConflictGraph:
+    # same node set as create_conflict_graph: the block's txs plus any tx only seen in reads / writes
+    nodes = list(dict.fromkeys([*txs, *reads, *writes]))
+    tx_ids = {tx_hash: i for i, tx_hash in enumerate(nodes)}
+    interner = KeyInterner()
+    for key_sets in (reads, writes):
+        for keys in key_sets.values():
+            interner.intern_set(keys)
+    R = create_incidence_matrix(tx_ids, reads, interner)
+    W = create_incidence_matrix(tx_ids, writes, interner)
+
+    # (i, j) conflicts if i writes a key j reads, or both write it
+    write_read = W @ R.T
+    adjacency = write_read + write_read.T + W @ W.T
+    adjacency.setdiag(0)
+    adjacency.eliminate_zeros()
+    adjacency = (adjacency > 0).tocsr()
+    return SparseConflictGraph(nodes, adjacency)
+
+
+def graph_average_degree(graph: SparseConflictGraph):
+    try:
+        num_nodes = graph.number_of_nodes()
+        if num_nodes == 0:
+            return 0.0
+        return (2 * graph.number_of_edges()) / num_nodes
+    except Exception as e:
+        print(f"Exception in graph_average_degree: {e}")
+        return float('nan')
+
+def graph_max_degree(graph: SparseConflictGraph):
+    try:
+        return int(graph.degrees().max(initial=0))
+    except Exception as e:
+        print(f"Exception in graph_max_degree: {e}")
+        return float('nan')
+
+def graph_density(graph: SparseConflictGraph):
+    try:
+        num_nodes = graph.number_of_nodes()
+        if num_nodes <= 1:
+            return 0
+        return (2 * graph.number_of_edges()) / (num_nodes * (num_nodes - 1))
+    except Exception as e:
+        print(f"Exception in graph_density: {e}")
+        return float('nan')
+
+def graph_conflict_percentage(graph: SparseConflictGraph):
+    try:
+        num_nodes = graph.number_of_nodes()
+        max_possible_edges = num_nodes * (num_nodes - 1) / 2
+        return (graph.number_of_edges() / max_possible_edges) * 100 if max_possible_edges > 0 else 0
+    except Exception as e:
+        print(f"Exception in graph_conflict_percentage: {e}")
+        return float('nan')
+
+def graph_largest_connected_component_size(graph: SparseConflictGraph):
+    try:
+        if graph.number_of_nodes() == 0:
+            return 0
+        _, labels = csgraph.connected_components(graph.adjacency, directed=False)
+        return int(np.bincount(labels).max())
+    except Exception as e:
+        print(f"Exception in graph_largest_connected_component_size: {e}")
+        return float('nan')
+
+def critical_path_length(graph: SparseConflictGraph) -> int:
+    # see graph_metrics.critical_path_length, row i of the strict lower triangle holds the earlier txs conflicting with tx i
+    earlier = sparse.tril(graph.adjacency, k=-1).tocsr()
+    chain = np.zeros(graph.number_of_nodes(), dtype=np.int64)
+    for i in range(len(chain)):
+        chain[i] = 1 + chain[earlier.indices[earlier.indptr[i]:earlier.indptr[i + 1]]].max(initial=0)
+    return int(chain.max(initial=0))
+
+def graph_critical_path_length(graph: SparseConflictGraph):
+    try:
+        return critical_path_length(graph)
+    except Exception as e:
+        print(f"Exception in graph_critical_path_length: {e}")
+        return float('nan')
+
+def graph_parallel_speedup_bound(graph: SparseConflictGraph):
+    try:
+        length = critical_path_length(graph)
+        if length == 0:
+            return float('nan')
+        return graph.number_of_nodes() / length
+    except Exception as e:
+        print(f"Exception in graph_parallel_speedup_bound: {e}")
+        return float('nan')
@@ -0,0 +1,134 @@
+import asyncio
+import itertools
+import json
+import socket
+import threading
+import time
+
+from aiohttp import web
+import pytest
+
+from async_fetchers import AsyncTraceFetcher, RpcError, fetch_traces
+from loaders import load_compressed_file
+from savers import save_compressed_to_file
+
+
+class FlakyFetcher(AsyncTraceFetcher):
+    # fails every first attempt, without a server
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.attempts = 0
+
+    async def post(self, endpoint, payload):
+        self.attempts += 1
+        if self.attempts == 1:
+            raise RpcError("busy")
+        return {"jsonrpc": "2.0", "id": payload["id"], "result": "ok"}
+
+
+def trace(block_number, tracer_config):
+    # null for every 5th block, large enough to span several streamed reads for every 7th
+    if block_number % 5 == 3:
+        return None
+    result = {"block": block_number, "diffMode": tracer_config.get("diffMode")}
+    if block_number % 7 == 0:
+        result["padding"] = "x" * 200000
+    return result
+
+def respond(request):
+    block_number = int(request["params"][0], 16)
+    result = json.dumps(trace(block_number, request["params"][1]["tracerConfig"]))
+    # nodes differ in where they put "result", so both orders are served
+    if block_number % 2 == 0:
+        return '{"jsonrpc":"2.0","id":%s,"result":%s}' % (json.dumps(request["id"]), result)
+    return '{"jsonrpc":"2.0","result":%s,\n "id":%s}\n' % (result, json.dumps(request["id"]))
+
+def unused_url():
+    # a port nothing listens on
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return f"http://127.0.0.1:{s.getsockname()[1]}/"
+
+@pytest.fixture(scope="module")
+def urls():
+    # (dead url, url failing every 3rd request with HTTP 500, healthy url), served from a background loop
+    requests_count = itertools.count()
+
+    async def handle(request):
+        payload = await request.json()
+        if request.path == "/flaky" and next(requests_count) % 3 == 0:
+            return web.Response(status=500, text="overloaded")
+        if isinstance(payload, list):
+            return web.Response(text="[%s]" % ",".join(respond(call) for call in payload))
+        return web.Response(text=respond(payload))
+
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+    ports = []
+
+    async def serve():
+        app = web.Application()
+        app.router.add_post("/{path:.*}", handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        ports.append(runner.addresses[0][1])
+        started.set()
+
+    thread = threading.Thread(target=lambda: (loop.run_until_complete(serve()), loop.run_forever()), daemon=True)
+    thread.start()
+    started.wait(10)
+    base = f"http://127.0.0.1:{ports[0]}"
+    yield [unused_url(), f"{base}/flaky", f"{base}/"]
+    loop.call_soon_threadsafe(loop.stop)
+
+FETCHER_OPTIONS = {"base_delay": 0.01, "max_delay": 0.05, "max_retries": 20}
+
+def expected_traces(block_numbers):
+    return [
+        (block_number, trace(block_number, {"diffMode": False}), trace(block_number, {"diffMode": True}))
+        for block_number in block_numbers
+    ]
+
+
+def test_backoff_releases_the_endpoint():
+    async def run():
+        async with FlakyFetcher(["http://localhost"], concurrency_per_endpoint=1, base_delay=0.5) as fetcher:
+            fetcher.backoff = lambda attempt: 0.5 if attempt == 0 else 0.0
+            call = asyncio.ensure_future(fetcher.call("debug_traceBlockByNumber", []))
+            await asyncio.sleep(0.2)
+            in_flight_while_backing_off = fetcher.endpoints[0].in_flight
+            return in_flight_while_backing_off, await call
+    in_flight, result = asyncio.run(run())
+    assert in_flight == 0
+    assert result == "ok"
+
+def test_fetch_traces_in_block_order(urls):
+    block_numbers = range(100, 160)
+    traces = list(fetch_traces(block_numbers, "prestate", urls, window=8, **FETCHER_OPTIONS))
+    assert traces == expected_traces(block_numbers)
+
+def test_fetch_traces_batched(urls):
+    block_numbers = range(200, 243)
+    traces = list(fetch_traces(block_numbers, "prestate", urls, window=8, batch_size=4, **FETCHER_OPTIONS))
+    assert traces == expected_traces(block_numbers)
+
+def test_compressed_traces_round_trip(urls, tmp_path):
+    block_numbers = range(300, 350)
+    path = str(tmp_path / "traces.h5")
+    save_compressed_to_file(
+        path, fetch_traces(block_numbers, "prestate", urls, window=8, compression_level=6, **FETCHER_OPTIONS),
+        chunk_size=16, block_range=block_numbers,
+    )
+    assert [tuple(entry) for entry in load_compressed_file(path)] == expected_traces(block_numbers)
+
+def test_closing_fetch_traces_stops_fetching(urls):
+    threads_before = threading.active_count()
+    traces = fetch_traces(range(10 ** 6), "prestate", urls[1:], window=8, **FETCHER_OPTIONS)
+    assert [block_number for block_number, *_ in itertools.islice(traces, 3)] == [0, 1, 2]
+    start = time.perf_counter()
+    traces.close()
+    assert time.perf_counter() - start < 10
+    time.sleep(0.5)
+    assert threading.active_count() <= threads_before
@@ -0,0 +1,63 @@
+import math
+import random
+import threading
+import time
+
+import networkx as nx
+
+from graph_metrics import SPARSE_METRICS, GraphAnalysis, get_graph_metrics, graph_clique, graph_diameter_ifub, graph_max_clique, run_metric
+from parsers import create_conflict_graph
+from sparse_graph import create_sparse_conflict_graph
+from test_parsers import random_read_write_sets
+
+
+def run_off_main_thread(function):
+    # SIGALRM only works on the main thread, so this exercises the cooperative budget used on Windows
+    result = []
+    thread = threading.Thread(target=lambda: result.append(function()))
+    thread.start()
+    thread.join()
+    return result[0]
+
+
+def test_budget_stops_metrics_without_sigalrm():
+    G = nx.gnp_random_graph(400, 0.6, seed=0)
+    for func in (graph_max_clique, graph_clique):
+        analysis = GraphAnalysis(G)
+        analysis.coloring
+        threads_before = threading.active_count()
+        start = time.perf_counter()
+        value, timed_out = run_off_main_thread(lambda: run_metric(func, analysis, 0.2))
+        assert timed_out and math.isnan(value)
+        assert time.perf_counter() - start < 2
+        # nothing left running in the background
+        assert threading.active_count() == threads_before
+
+def test_within_budget_without_sigalrm():
+    G = nx.cycle_graph(10)
+    assert run_off_main_thread(lambda: run_metric(graph_max_clique, GraphAnalysis(G), 10)) == (2, False)
+
+def test_clique_limits_are_per_call():
+    G = nx.gnp_random_graph(200, 0.5, seed=0)
+    limited = get_graph_metrics(G, metrics=["clique_number", "clique_upper_bound"], clique_node_limit=10)
+    exact = get_graph_metrics(G, metrics=["clique_number", "clique_upper_bound"])
+    assert limited["clique_number"] <= exact["clique_number"] == exact["clique_upper_bound"] <= limited["clique_upper_bound"]
+    assert limited["clique_number"] < limited["clique_upper_bound"]
+
+def test_sparse_metrics_match_networkx():
+    rng = random.Random(2)
+    for _ in range(200):
+        txs, reads, writes = random_read_write_sets(rng, rng.randrange(0, 60), rng.randrange(1, 30))
+        expected = get_graph_metrics(create_conflict_graph(txs, reads, writes), metrics=sorted(SPARSE_METRICS))
+        results = get_graph_metrics(create_sparse_conflict_graph(txs, reads, writes), metrics=sorted(SPARSE_METRICS))
+        assert results.keys() == expected.keys()
+        for name, value in results.items():
+            assert value == expected[name] or (math.isnan(value) and math.isnan(expected[name])) or math.isclose(value, expected[name]), name
+
+def test_diameter_matches_networkx():
+    rng = random.Random(1)
+    for _ in range(200):
+        nodes_count = rng.randrange(1, 80)
+        G = nx.gnp_random_graph(nodes_count, rng.choice([0.02, 0.05, 0.1, 0.3]), seed=rng.randrange(1 << 30))
+        expected = max(nx.diameter(G.subgraph(component)) for component in nx.connected_components(G))
+        assert graph_diameter_ifub(G) == expected
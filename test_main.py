@@ -0,0 +1,116 @@
+import threading
+import time
+
+from functools import partial
+
+import h5py
+import pandas as pd
+
+from main import build_parsed_cache, generate_data_files, get_budgets, load_file_chunk_tasks, main, parse_args, process_prestate_trace, read_concurrently
+from savers import save_to_file
+
+
+def numbers(start, count):
+    for i in range(start, start + count):
+        yield i
+
+def fail_on_block(block_number, value):
+    if block_number == 5:
+        raise ValueError(f"bad block {block_number}")
+    return {"block_number": block_number, "txs": 0}
+
+def prestate_blocks(start, count):
+    # block_number's two txs both write 0xa
+    for block_number in range(start, start + count):
+        txs = [f"0x{block_number:x}{i}" for i in range(2)]
+        diffFalse = [{"txHash": tx_hash, "result": {"0xa": {"balance": "0x1"}}} for tx_hash in txs]
+        diffTrue = [{"txHash": tx_hash, "result": {"pre": {"0xa": {"balance": "0x1"}}, "post": {"0xa": {"balance": "0x2"}}}} for tx_hash in txs]
+        yield [block_number, diffFalse, diffTrue]
+
+def run_in_thread(function, timeout):
+    # (finished, exception raised by function)
+    errors = []
+    def run():
+        try:
+            function()
+        except Exception as e:
+            errors.append(e)
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    return not thread.is_alive(), errors[0] if len(errors) > 0 else None
+
+
+def test_read_concurrently_yields_every_item():
+    items = read_concurrently([numbers(0, 100), numbers(100, 100), numbers(200, 100)], readers=2, max_queued=2)
+    assert sorted(items) == list(range(300))
+
+def test_read_concurrently_stops_readers_when_closed():
+    before = threading.active_count()
+    items = read_concurrently([numbers(0, 10 ** 6), numbers(0, 10 ** 6)], readers=2, max_queued=2)
+    next(items)
+    finished, _ = run_in_thread(items.close, timeout=10)
+    assert finished
+    time.sleep(0.5)
+    assert threading.active_count() <= before
+
+def test_failed_task_fails_instead_of_hanging(tmp_path):
+    shards = []
+    for i_file in range(3):
+        data_path = str(tmp_path / f"{i_file}.h5")
+        save_to_file(data_path, ([block_number, None] for block_number in range(i_file * 300, (i_file + 1) * 300)))
+        shards.append((data_path, None))
+    finished, error = run_in_thread(lambda: generate_data_files(
+        shards, str(tmp_path / "output.csv"), fail_on_block, use_parsed_cache=False, workers=2, window=2, batch_txs=1,
+    ), timeout=60)
+    assert finished
+    assert isinstance(error, ValueError)
+
+def test_chunk_tasks_carry_only_their_chunks_skip_blocks(tmp_path):
+    data_path = str(tmp_path / "unindexed.h5")
+    save_to_file(data_path, ([block_number, None] for block_number in range(1000)))
+    with h5py.File(data_path, 'a') as f:
+        del f['index']
+    skip_blocks = set(range(0, 1000, 2)) | set(range(10 ** 6, 2 * 10 ** 6))
+    tasks = list(load_file_chunk_tasks(data_path, fail_on_block, skip_blocks=skip_blocks, use_parsed_cache=False))
+    assert len(tasks) == 10
+    for _, _, _, i_chunk, chunk_skip_blocks, _ in tasks:
+        assert chunk_skip_blocks == set(range(i_chunk * 100, (i_chunk + 1) * 100, 2))
+
+def test_parse_cache_with_storage_slots_off(tmp_path):
+    data_path = str(tmp_path / "traces.h5")
+    save_to_file(data_path, prestate_blocks(0, 10))
+    build_parsed_cache(data_path, process_prestate_trace)
+    processor = partial(process_prestate_trace, storage_slots=False, metrics=["degree"])
+    generate_data_files([(data_path, None)], str(tmp_path / "output.csv"), processor, workers=1)
+    df = pd.read_csv(tmp_path / "output.csv")
+    assert sorted(df["block_number"]) == list(range(10))
+    assert list(df["degree"]) == [1.0] * 10
+
+def test_partial_parse_cache_is_not_used(tmp_path):
+    data_path = str(tmp_path / "traces.h5")
+    save_to_file(data_path, prestate_blocks(0, 10))
+    build_parsed_cache(data_path, process_prestate_trace, limit=5)
+    generate_data_files([(data_path, None)], str(tmp_path / "output.csv"), partial(process_prestate_trace, metrics=["degree"]), workers=1)
+    assert sorted(pd.read_csv(tmp_path / "output.csv")["block_number"]) == list(range(10))
+
+def test_block_range_on_an_unindexed_file(tmp_path):
+    data_path = str(tmp_path / "unindexed.h5")
+    save_to_file(data_path, prestate_blocks(0, 300))
+    with h5py.File(data_path, 'a') as f:
+        del f['index']
+    generate_data_files([(data_path, range(150, 160))], str(tmp_path / "output.csv"), partial(process_prestate_trace, metrics=["degree"]),
+                        use_parsed_cache=False, workers=1)
+    assert sorted(pd.read_csv(tmp_path / "output.csv")["block_number"]) == list(range(150, 160))
+
+def test_budget_options(tmp_path):
+    assert get_budgets(parse_args(["traces", "--budget", "5"]).budget) == 5
+    assert get_budgets(parse_args(["traces", "--budget", "2", "expensive=10", "clique_number=1"]).budget) == {
+        "cheap": 2, "medium": 2, "expensive": 10, "clique_number": 1,
+    }
+    data_path = str(tmp_path / "traces.h5")
+    save_to_file(data_path, prestate_blocks(0, 10))
+    main([data_path, "--output", str(tmp_path / "output.csv"), "--metrics", "degree", "clique_number", "--budget", "60", "--workers", "1", "--no-plot"])
+    df = pd.read_csv(tmp_path / "output.csv", keep_default_na=False)
+    assert list(df["timed_out"]) == [""] * 10
+    assert list(df["clique_number"]) == [2] * 10
@@ -0,0 +1,44 @@
+import random
+
+from parsers import create_conflict_graph, create_conflict_graph_pairwise, parse_preStateTracer_trace
+
+
+def prestate(accounts):
+    # diffMode=False result: address -> slots the tx accessed
+    return {
+        address: {"balance": "0x1", "nonce": 1, "code": "0x60", "storage": {slot: "0x1" for slot in slots}}
+        for address, slots in accounts.items()
+    }
+
+def random_read_write_sets(rng: random.Random, txs_count: int, keys_count: int):
+    txs = [f"0x{i:04x}" for i in range(txs_count)]
+    keys = [f"0xkey{i}" for i in range(keys_count)]
+    # like the trace parsers, txs without reads / writes are left out
+    reads = {tx_hash: set(rng.sample(keys, rng.randrange(0, min(4, keys_count + 1)))) for tx_hash in txs if rng.random() < 0.8}
+    writes = {tx_hash: set(rng.sample(keys, rng.randrange(0, min(3, keys_count + 1)))) for tx_hash in txs if rng.random() < 0.6}
+    return txs, reads, writes
+
+
+def test_conflict_graph_matches_pairwise():
+    rng = random.Random(0)
+    for _ in range(200):
+        txs, reads, writes = random_read_write_sets(rng, rng.randrange(0, 60), rng.randrange(1, 30))
+        G = create_conflict_graph(txs, reads, writes)
+        reference = create_conflict_graph_pairwise(txs, reads, writes)
+        assert set(G.nodes) == set(reference.nodes)
+        assert {frozenset(edge) for edge in G.edges} == {frozenset(edge) for edge in reference.edges}
+
+def test_storage_slots_destructed_account_writes_its_fields():
+    # t1 destructs 0xa, which has storage: 0xa is in pre with that storage and left out of post
+    diffFalse = [
+        {"txHash": "t1", "result": prestate({"0xa": ["0x1"]})},
+        {"txHash": "t2", "result": {"0xa": {"balance": "0x1"}}},
+    ]
+    diffTrue = [
+        {"txHash": "t1", "result": {"pre": {"0xa": {"balance": "0x1", "storage": {"0x1": "0x1"}}}, "post": {}}},
+        {"txHash": "t2", "result": {"pre": {}, "post": {}}},
+    ]
+    for storage_slots in (False, True):
+        reads, writes = parse_preStateTracer_trace(diffFalse, diffTrue, storage_slots=storage_slots)
+        G = create_conflict_graph(["t1", "t2"], reads, writes)
+        assert G.has_edge("t1", "t2"), storage_slots
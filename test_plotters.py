@@ -0,0 +1,52 @@
+import os
+
+import matplotlib
+matplotlib.use("Agg")
+import numpy as np
+import pandas as pd
+
+from parsers import CALL_METRIC_COLUMNS
+from plotters import plot_data
+
+
+def write_output(path, metrics, rows = 200, call_metrics = False):
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({metric: rng.integers(1, 50, rows) for metric in metrics})
+    if call_metrics:
+        for column in CALL_METRIC_COLUMNS:
+            df[column] = rng.random(rows)
+    df["density"] = rng.random(rows)
+    df["timed_out"] = ["clique_number" if i % 7 == 0 else "" for i in range(rows)]
+    df["block_number"] = np.arange(rows)
+    df["txs"] = rng.integers(1, 300, rows)
+    for stage in ["parse", "graph"] + metrics:
+        df[f"t_{stage}"] = rng.random(rows)
+        df[f"m_{stage}"] = rng.integers(0, 1 << 20, rows)
+    df.to_csv(path, index=False)
+
+def plotted_properties(directory):
+    # plot_data saves to figures\\<prop>.png, a plain file name off Windows
+    return {name.split("\\")[-1][:-len(".png")] for name in os.listdir(directory) if name.endswith(".png")}
+
+
+def test_plot_data_skips_timing_and_timed_out_columns(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    metrics = ["greedy_color", "clique_number", "largest_conn_comp", "longest_path_length_monte_carlo"]
+    write_output("output.csv", metrics)
+    plot_data("output.csv")
+    plotted = plotted_properties(tmp_path)
+    assert set(metrics) <= plotted
+    assert not any(name.startswith(("t_", "m_")) or name == "timed_out" for name in plotted)
+
+def test_plot_data_with_a_partial_metric_selection(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_output("output.csv", ["degree", "largest_conn_comp"])
+    plot_data("output.csv")
+    plotted = plotted_properties(tmp_path)
+    assert {"degree", "largest_conn_comp"} <= plotted
+
+def test_plot_data_keeps_call_metrics(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_output("output.csv", ["degree"], call_metrics=True)
+    plot_data("output.csv")
+    assert set(CALL_METRIC_COLUMNS) <= plotted_properties(tmp_path)
@@ -0,0 +1,24 @@
+import os
+
+from trace_cache import TraceCache
+
+
+def test_lru_eviction_keeps_recent_traces(tmp_path):
+    cache = TraceCache(str(tmp_path), max_bytes=2000)
+    traces = [{"block": block_number, "data": os.urandom(100).hex()} for block_number in range(20)]
+    for block_number, trace in enumerate(traces):
+        cache.put(block_number, "callTracer", {}, trace)
+        cache.get(0, "callTracer", {})
+    assert cache.get(0, "callTracer", {}) == traces[0]
+    assert cache.get(19, "callTracer", {}) is not None
+    assert cache.get(1, "callTracer", {}) is None
+    assert cache.stats()["bytes"] <= 2000
+
+def test_eviction_survives_undeletable_files(tmp_path, monkeypatch):
+    cache = TraceCache(str(tmp_path), max_bytes=500)
+    def remove(path):
+        raise PermissionError(f"{path} is open in another process")
+    monkeypatch.setattr(os, "remove", remove)
+    for block_number in range(10):
+        cache.put(block_number, "prestateTracer", {"diffMode": True}, {"data": os.urandom(100).hex()})
+    assert cache.stats()["evictions"] > 0
@@ -0,0 +1,31 @@
+from contextlib import contextmanager, nullcontext
+import time
+import tracemalloc
+from typing import Dict, Optional
+
+
+class StageTimer:
+    """Records the wall time, and optionally the peak traced memory, of each named stage of one block."""
+
+    def __init__(self, trace_memory: bool = False):
+        self.trace_memory = trace_memory
+        self.columns: Dict[str, float] = {}
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name: str):
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.columns[f"t_{name}"] = time.perf_counter() - start
+            if self.trace_memory:
+                _, peak = tracemalloc.get_traced_memory()
+                self.columns[f"m_{name}"] = peak
+
+def timed(timer: Optional[StageTimer], name: str):
+    # no-op context when instrumentation is disabled
+    return timer.stage(name) if timer is not None else nullcontext()
@@ -0,0 +1,131 @@
+from collections import OrderedDict
+import gzip
+import hashlib
+import json
+import os
+import threading
+from typing import Optional
+
+from chunk_codecs import gzip_member
+
+
+class TraceCache:
+    """
+    On-disk cache of debug_traceBlockByNumber results, one file per (block number, tracer, tracerConfig).
+    A file holds a gzip member of the result's json text, the same bytes the streaming fetch path writes
+    into chunks, so a cached trace can go to a chunk without being decoded. The least recently used
+    files are evicted once the cache holds more than max_bytes. Null results are never cached.
+    Safe to share between threads; files are written under a temporary name and renamed, so concurrent
+    processes sharing a directory never read a partial file.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 10 << 30, level: int = 6):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.level = level
+        self.lock = threading.Lock()
+        # key -> file size, least recently used first; recency survives restarts through the files' mtime
+        self.entries: OrderedDict = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        files = []
+        for subdirectory in os.listdir(directory):
+            subdirectory = os.path.join(directory, subdirectory)
+            if os.path.isdir(subdirectory):
+                for name in os.listdir(subdirectory):
+                    if name.endswith(".gz"):
+                        stat = os.stat(os.path.join(subdirectory, name))
+                        files.append((stat.st_mtime, name[:-len(".gz")], stat.st_size))
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+            self.size += size
+        with self.lock:
+            self.evict()
+
+    @staticmethod
+    def key(block_number: int, tracer_name: str, tracer_config: dict) -> str:
+        return hashlib.sha256(json.dumps([block_number, tracer_name, tracer_config], sort_keys=True).encode()).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.gz")
+
+    def get_compressed(self, block_number: int, tracer_name: str, tracer_config: dict = {}) -> Optional[bytes]:
+        key = self.key(block_number, tracer_name, tracer_config)
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        try:
+            with open(self.path(key), "rb") as file:
+                data = file.read()
+            os.utime(self.path(key))
+            return data
+        except FileNotFoundError:
+            # evicted by another process sharing the directory
+            with self.lock:
+                if key in self.entries:
+                    self.size -= self.entries.pop(key)
+                self.hits -= 1
+                self.misses += 1
+            return None
+
+    def put_compressed(self, block_number: int, tracer_name: str, tracer_config: dict, data: bytes) -> None:
+        key = self.key(block_number, tracer_name, tracer_config)
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # unique per process and thread, thread idents alone repeat across processes
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, "wb") as file:
+                file.write(data)
+            os.replace(temp_path, path)
+        except OSError:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)
+            self.entries[key] = len(data)
+            self.size += len(data)
+            self.evict()
+
+    def get(self, block_number: int, tracer_name: str, tracer_config: dict = {}):
+        data = self.get_compressed(block_number, tracer_name, tracer_config)
+        return json.loads(gzip.decompress(data)) if data is not None else None
+
+    def put(self, block_number: int, tracer_name: str, tracer_config: dict, result) -> None:
+        if result is not None:
+            self.put_compressed(block_number, tracer_name, tracer_config, gzip_member(json.dumps(result).encode(), self.level))
+
+    def evict(self) -> None:
+        # with self.lock held
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            key, size = self.entries.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+            try:
+                os.remove(self.path(key))
+            except OSError as e:
+                # already gone, or open elsewhere (Windows); the file is only out of the budget's accounting
+                if not isinstance(e, FileNotFoundError):
+                    print(f"Error evicting {self.path(key)} from the trace cache: {e}")
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups > 0 else float('nan'),
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.size,
+            }